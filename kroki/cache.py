@@ -1,7 +1,10 @@
 import hashlib
 import os
 import tempfile
+import threading
 import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 
@@ -29,7 +32,7 @@ def _determine_cache_dir(custom_dir: Optional[str]) -> Path:
     return Path(tmpdir) / "kroki"
 
 
-def _get_cache_key(
+def get_cache_key(
     diagram_source: str, diagram_type: str, file_ext: str, options: dict
 ) -> str:
     """Generate a cache key based on diagram content and metadata.
@@ -49,17 +52,193 @@ def _get_cache_key(
     return hashlib.sha256(cache_data.encode()).hexdigest()
 
 
+@dataclass
+class CacheStats:
+    """Counters of the cache usage during a build."""
+
+    memory_hits: int = 0
+    file_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class MemoryCache:
+    """In-memory LRU cache bounded by the total size of the stored content."""
+
+    def __init__(self, max_bytes: int, stats: CacheStats) -> None:
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.stats = stats
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+
+    def __contains__(self, cache_key: str) -> bool:
+        return cache_key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, cache_key: str) -> Optional[bytes]:
+        content = self._entries.get(cache_key)
+        if content is not None:
+            self._entries.move_to_end(cache_key)
+        return content
+
+    def set(self, cache_key: str, content: bytes) -> None:
+        self.discard(cache_key)
+        if len(content) > self.max_bytes:
+            # would evict everything else, keep it in the file cache only
+            return
+
+        self._entries[cache_key] = content
+        self.size_bytes += len(content)
+        while self.size_bytes > self.max_bytes:
+            _, evicted_content = self._entries.popitem(last=False)
+            self.size_bytes -= len(evicted_content)
+            self.stats.evictions += 1
+
+    def discard(self, cache_key: str) -> None:
+        content = self._entries.pop(cache_key, None)
+        if content is not None:
+            self.size_bytes -= len(content)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size_bytes = 0
+
+
+class CacheIndex:
+    """Compact record of the cached files with their size and last access time.
+
+    The index is an append-only text file with one ``<file name> <size>
+    <last access>`` line per update, later lines win. New entries are appended
+    immediately, access time updates are appended on flush and the file is
+    rewritten once it holds too many outdated lines. Other builds may share the
+    cache directory, their lines are merged into the rewritten file.
+    """
+
+    def __init__(self, index_path: Path) -> None:
+        self.index_path = index_path
+        self.entries: dict[str, tuple[int, int]] = {}
+        self._pending: set[str] = set()
+        # removed by this build since the last rewrite, not merged back in
+        self._removed: set[str] = set()
+        self._line_count = 0
+        self._needs_rewrite = False
+
+    def __contains__(self, file_name: str) -> bool:
+        return file_name in self.entries
+
+    def _read(self) -> tuple[dict[str, tuple[int, int]], int]:
+        entries = {}
+        line_count = 0
+        with open(self.index_path) as index_file:
+            for line in index_file:
+                line_count += 1
+                try:
+                    file_name, size, last_access = line.split()
+                    entries[file_name] = (int(size), int(last_access))
+                except ValueError:
+                    continue
+        return entries, line_count
+
+    def load(self) -> bool:
+        """Read the index file, returns False if there is none."""
+        try:
+            file_entries, self._line_count = self._read()
+        except FileNotFoundError:
+            return False
+
+        self.entries.update(file_entries)
+        return True
+
+    def _merge_file_entries(self) -> None:
+        """Take over the entries other builds appended since the index was loaded."""
+        try:
+            file_entries, _ = self._read()
+        except FileNotFoundError:
+            return
+
+        for file_name, (size, last_access) in file_entries.items():
+            if file_name in self._removed:
+                continue
+            known_entry = self.entries.get(file_name)
+            if known_entry is None or known_entry[1] < last_access:
+                self.entries[file_name] = (size, last_access)
+
+    def _format_line(self, file_name: str) -> str:
+        size, last_access = self.entries[file_name]
+        return f"{file_name} {size} {last_access}\n"
+
+    def _append(self, file_names: list[str]) -> None:
+        with open(self.index_path, "a") as index_file:
+            index_file.write("".join(map(self._format_line, file_names)))
+        self._line_count += len(file_names)
+
+    def add(self, file_name: str, size: int, last_access: None | int = None) -> None:
+        self.entries[file_name] = (size, last_access or int(time.time()))
+        self._pending.discard(file_name)
+        self._append([file_name])
+
+    def touch(self, file_name: str) -> None:
+        size, _ = self.entries[file_name]
+        self.entries[file_name] = (size, int(time.time()))
+        self._pending.add(file_name)
+
+    def remove(self, file_name: str) -> None:
+        if self.entries.pop(file_name, None) is not None:
+            self._pending.discard(file_name)
+            self._removed.add(file_name)
+            self._needs_rewrite = True
+
+    def rewrite(self) -> None:
+        """Replace the index file with the current entries and those of other builds."""
+        self._merge_file_entries()
+        tmp_path = self.index_path.with_name(
+            f"{self.index_path.name}.{os.getpid()}.tmp"
+        )
+        with open(tmp_path, "w") as index_file:
+            index_file.writelines(map(self._format_line, self.entries))
+        os.replace(tmp_path, self.index_path)
+        self._line_count = len(self.entries)
+        self._pending.clear()
+        self._removed.clear()
+        self._needs_rewrite = False
+
+    def flush(self) -> None:
+        """Write pending updates, compacting the file when it got too long."""
+        if self._needs_rewrite or self._line_count > 2 * len(self.entries) + 100:
+            self.rewrite()
+        elif self._pending:
+            self._append(sorted(self._pending))
+            self._pending.clear()
+
+
 class KrokiCache:
     """Manages caching of rendered diagrams to avoid re-rendering unchanged diagrams.
 
-    Uses an access-time based LRU strategy: files are touched on read,
-    and old unused files are cleaned up on initialization.
+    Files are stored in a sharded layout (``ab/cd/<hash>.<ext>``) and tracked in
+    a ``CacheIndex``. Uses an access-time based LRU strategy: access times are
+    recorded in the index, and old unused files are cleaned up after the build.
     """
 
     # Cache TTL in seconds (3 days)
     CACHE_TTL_SECONDS = 3 * 24 * 60 * 60
 
-    def __init__(self, cache_dir: Optional[str] = None) -> None:
+    # Time a single cleanup may take, the remaining files are removed next time
+    CLEANUP_TIME_BUDGET_SECONDS = 1.0
+
+    # Default size limit of the in-memory cache in MB
+    DEFAULT_MEMORY_LIMIT_MB = 64
+
+    INDEX_FILE_NAME = "index"
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        memory_limit_mb: int = DEFAULT_MEMORY_LIMIT_MB,
+        ttl_seconds: float = CACHE_TTL_SECONDS,
+        max_size_mb: None | int = None,
+    ) -> None:
         """Initialize the cache.
 
         Args:
@@ -67,12 +246,22 @@ class KrokiCache:
                        1. $XDG_CACHE_HOME/kroki
                        2. $HOME/.cache/kroki
                        3. $TMPDIR/kroki or temp directory/kroki
+            memory_limit_mb: Size limit of the in-memory cache, 0 disables it
+            ttl_seconds: Time after which unused files are removed by the cleanup
+            max_size_mb: Optional size limit of the file cache, enforced by the cleanup
         """
-        self.in_memory_cache: dict[str, bytes] = {}
+        self.stats = CacheStats()
+        self.in_memory_cache = MemoryCache(memory_limit_mb * 1024 * 1024, self.stats)
         self.cache_path: Path | None = _determine_cache_dir(cache_dir)
+        self.index: CacheIndex | None = None
+        self.ttl_seconds = ttl_seconds
+        self.max_size_bytes = None if max_size_mb is None else max_size_mb * 1024 * 1024
+        # guards the memory cache, the index and the stats, files are read and
+        # written outside, so I/O threads don't wait for each other
+        self._lock = threading.Lock()
         log.debug("Using cache directory: %s", self.cache_path)
         self._ensure_cache_dir()
-        self._cleanup_old_cache_files()
+        self._load_index()
 
     def _ensure_cache_dir(self) -> None:
         """Create cache directory if it doesn't exist."""
@@ -85,35 +274,141 @@ class KrokiCache:
                 )
                 self.cache_path = None
 
-    def _cleanup_old_cache_files(self) -> None:
-        """Remove cache files that haven't been accessed in CACHE_TTL_SECONDS."""
-        if not self.cache_path or not self.cache_path.exists():
+    def _get_cache_file(self, file_name: str) -> Path:
+        """Get the sharded location of a cache file: ``ab/cd/abcd...``."""
+        if self.cache_path is None:
+            err_msg = "Cache directory is not available"
+            raise RuntimeError(err_msg)
+        return self.cache_path / file_name[:2] / file_name[2:4] / file_name
+
+    def _load_index(self) -> None:
+        """Load the cache index, building it from the cache directory if missing."""
+        if not self.cache_path:
+            return
+
+        self.index = CacheIndex(self.cache_path / self.INDEX_FILE_NAME)
+        if self.index.load():
+            return
+
+        try:
+            self._migrate_cache_files()
+            self.index.rewrite()
+        except Exception as e:
+            log.warning("Could not build cache index: %s", e)
+            self.index = None
+            self.cache_path = None
+
+    def _migrate_cache_files(self) -> None:
+        """Index the sharded cache files and move files of the flat layout into shards."""
+        if not self.cache_path or not self.index:
+            return
+
+        migrated_count = 0
+        for entry in self.cache_path.iterdir():
+            if entry.is_dir():
+                for shard_file in entry.glob("*/*"):
+                    if shard_file.is_file():
+                        stat = shard_file.stat()
+                        self.index.entries[shard_file.name] = (
+                            stat.st_size,
+                            int(stat.st_mtime),
+                        )
+                continue
+
+            if entry.name.startswith(self.INDEX_FILE_NAME):
+                continue
+
+            # flat layout of previous versions
+            stat = entry.stat()
+            cache_file = self._get_cache_file(entry.name)
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(entry, cache_file)
+            self.index.entries[entry.name] = (stat.st_size, int(stat.st_mtime))
+            migrated_count += 1
+
+        if migrated_count > 0:
+            log.info("Migrated %d cache files to the sharded layout", migrated_count)
+
+    def _get_files_to_remove(self) -> list[str]:
+        """Get expired files and, beyond the size limit, the least recently used ones."""
+        if not self.index:
+            return []
+
+        cutoff_time = time.time() - self.ttl_seconds
+        files_to_remove = []
+        remaining_entries = []
+        for file_name, (size, last_access) in self.index.entries.items():
+            if last_access < cutoff_time:
+                files_to_remove.append(file_name)
+            else:
+                remaining_entries.append((last_access, size, file_name))
+
+        if self.max_size_bytes is not None:
+            total_size = sum(size for _, size, _ in remaining_entries)
+            for _, size, file_name in sorted(remaining_entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                files_to_remove.append(file_name)
+                total_size -= size
+
+        return files_to_remove
+
+    def cleanup(self, time_budget_seconds: float = CLEANUP_TIME_BUDGET_SECONDS) -> None:
+        """Remove expired cache files and enforce the size limit of the file cache.
+
+        The cleanup works on the index only and stops after time_budget_seconds,
+        the remaining files are found and removed by the next cleanup.
+        """
+        if not self.cache_path or not self.index:
             return
 
         try:
-            current_time = time.time()
-            cutoff_time = current_time - self.CACHE_TTL_SECONDS
+            deadline = time.monotonic() + time_budget_seconds
+            files_to_remove = self._get_files_to_remove()
             deleted_count = 0
 
-            for cache_file in self.cache_path.iterdir():
-                if not cache_file.is_file():
-                    continue
+            for file_name in files_to_remove:
+                if time.monotonic() > deadline:
+                    log.debug(
+                        "Cache cleanup paused, %d files left",
+                        len(files_to_remove) - deleted_count,
+                    )
+                    break
 
                 try:
-                    # Check modification time (last access time when we touch files)
-                    mtime = cache_file.stat().st_mtime
-                    if mtime < cutoff_time:
-                        cache_file.unlink()
-                        deleted_count += 1
+                    self._get_cache_file(file_name).unlink(missing_ok=True)
+                    self.index.remove(file_name)
+                    deleted_count += 1
                 except Exception as e:
-                    log.debug("Could not delete cache file %s: %s", cache_file, e)
+                    log.debug("Could not delete cache file %s: %s", file_name, e)
 
             if deleted_count > 0:
+                self.index.flush()
                 log.info("Cleaned up %d old cache files", deleted_count)
 
         except Exception as e:
             log.warning("Error during cache cleanup: %s", e)
 
+    def flush(self) -> None:
+        """Persist the recorded access times to the cache index."""
+        if self.index:
+            try:
+                self.index.flush()
+            except Exception as e:
+                log.warning("Could not write cache index: %s", e)
+
+    def get_from_memory(
+        self, diagram_source: str, diagram_type: str, file_ext: str, options: dict
+    ) -> Optional[bytes]:
+        """Retrieve a cached diagram from the in-memory cache only, without any I/O."""
+        cache_key = get_cache_key(diagram_source, diagram_type, file_ext, options)
+        with self._lock:
+            content = self.in_memory_cache.get(cache_key)
+            if content is not None:
+                self.stats.memory_hits += 1
+                log.debug("Cache hit (memory): %s", cache_key[:16])
+            return content
+
     def get(
         self, diagram_source: str, diagram_type: str, file_ext: str, options: dict
     ) -> Optional[bytes]:
@@ -128,31 +423,50 @@ class KrokiCache:
         Returns:
             Cached diagram content as bytes, or None if not cached
         """
-        cache_key = _get_cache_key(diagram_source, diagram_type, file_ext, options)
-
-        # Check in-memory cache first
-        if cache_key in self.in_memory_cache:
-            log.debug("Cache hit (memory): %s", cache_key[:16])
-            return self.in_memory_cache[cache_key]
+        return self.get_by_key(
+            get_cache_key(diagram_source, diagram_type, file_ext, options), file_ext
+        )
+
+    def get_by_key(self, cache_key: str, file_ext: str) -> None | bytes:
+        """Retrieve a cached diagram by the key of its diagram source, type and options."""
+        with self._lock:
+            # Check in-memory cache first
+            content = self.in_memory_cache.get(cache_key)
+            if content is not None:
+                self.stats.memory_hits += 1
+                log.debug("Cache hit (memory): %s", cache_key[:16])
+                return content
+
+            file_name = f"{cache_key}.{file_ext}"
+            is_indexed = self.index is not None and file_name in self.index
 
         # Check file cache
-        if self.cache_path:
-            cache_file = self.cache_path / f"{cache_key}.{file_ext}"
-            if cache_file.exists():
+        if self.cache_path and self.index:
+            cache_file = self._get_cache_file(file_name)
+            # files might have been added by another build using the same cache
+            if is_indexed or cache_file.exists():
                 try:
                     content = cache_file.read_bytes()
-                    # Touch file to update access time (LRU strategy)
-                    try:
-                        cache_file.touch()
-                    except Exception:
-                        pass  # Ignore touch errors, not critical
-                    # Store in memory cache for faster future access
-                    self.in_memory_cache[cache_key] = content
-                    log.debug("Cache hit (file): %s", cache_key[:16])
-                    return content
+                except FileNotFoundError:
+                    with self._lock:
+                        self.index.remove(file_name)
                 except Exception as e:
                     log.warning("Could not read cache file %s: %s", cache_file, e)
+                else:
+                    with self._lock:
+                        # Record access time (LRU strategy)
+                        if file_name in self.index:
+                            self.index.touch(file_name)
+                        else:
+                            self.index.add(file_name, len(content))
+                        # Store in memory cache for faster future access
+                        self.in_memory_cache.set(cache_key, content)
+                        self.stats.file_hits += 1
+                    log.debug("Cache hit (file): %s", cache_key[:16])
+                    return content
 
+        with self._lock:
+            self.stats.misses += 1
         log.debug("Cache miss: %s", cache_key[:16])
         return None
 
@@ -173,16 +487,26 @@ class KrokiCache:
             options: Diagram rendering options
             content: The rendered diagram content
         """
-        cache_key = _get_cache_key(diagram_source, diagram_type, file_ext, options)
+        cache_key = get_cache_key(diagram_source, diagram_type, file_ext, options)
 
-        # Always store in memory cache
-        self.in_memory_cache[cache_key] = content
+        # Store in memory cache, as far as its size limit allows
+        with self._lock:
+            self.in_memory_cache.set(cache_key, content)
 
         # Store in file cache if available
-        if self.cache_path:
-            cache_file = self.cache_path / f"{cache_key}.{file_ext}"
+        if self.cache_path and self.index:
+            file_name = f"{cache_key}.{file_ext}"
+            cache_file = self._get_cache_file(file_name)
+            # readers in other threads or builds must not see partial files
+            tmp_file = cache_file.with_name(
+                f"{file_name}.{os.getpid()}-{threading.get_ident()}.tmp"
+            )
             try:
-                cache_file.write_bytes(content)
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file.write_bytes(content)
+                os.replace(tmp_file, cache_file)
+                with self._lock:
+                    self.index.add(file_name, len(content))
                 log.debug("Cached to file: %s", cache_key[:16])
             except Exception as e:
                 log.warning("Could not write cache file %s: %s", cache_file, e)
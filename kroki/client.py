@@ -1,56 +1,192 @@
+import asyncio
 import base64
+import posixpath
+import random
 import textwrap
+import time
 import zlib
-from os import makedirs, path
-from typing import Final
-from uuid import NAMESPACE_OID, uuid3
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from functools import partial
+from os import makedirs, path, replace
+from typing import Any, Final, TypeVar
 
 import httpx
+from mkdocs.exceptions import PluginError
 from result import Err, Ok, Result
 
-from kroki.cache import KrokiCache
+from kroki.cache import KrokiCache, get_cache_key
 from kroki.common import (
+    BuildStats,
+    CachedHtml,
     ErrorResult,
     ImageSrc,
     KrokiImageContext,
     MkDocsEventContext,
     MkDocsFile,
+    SavedFile,
 )
 from kroki.diagram_types import KrokiDiagramTypes
 from kroki.logging import log
+from kroki.svg import optimize_svg
 
 FILE_PREFIX: Final[str] = "kroki-generated-"
 
+_T = TypeVar("_T")
+
+_RETRY_STATUS_CODES: Final[frozenset[int]] = frozenset(
+    {
+        httpx.codes.TOO_MANY_REQUESTS,
+        httpx.codes.INTERNAL_SERVER_ERROR,
+        httpx.codes.BAD_GATEWAY,
+        httpx.codes.SERVICE_UNAVAILABLE,
+        httpx.codes.GATEWAY_TIMEOUT,
+    }
+)
+# transport errors that may be gone on the next attempt, e.g. a restarted
+# server closing a pooled keep-alive connection without a response
+_RETRY_EXCEPTIONS: Final[tuple[type[httpx.TransportError], ...]] = (
+    httpx.TimeoutException,
+    httpx.NetworkError,
+    httpx.RemoteProtocolError,
+)
+_RETRY_MAX_DELAY_SECONDS: Final[float] = 60.0
+# threads reading and writing the cache and the site, so the event loop keeps
+# sending requests while waiting for the disk
+_IO_THREADS: Final[int] = 4
+# responses of batch endpoints not supporting batches, diagrams are requested one by one
+_BATCH_UNSUPPORTED_STATUS_CODES: Final[frozenset[int]] = frozenset(
+    {
+        httpx.codes.NOT_FOUND,
+        httpx.codes.METHOD_NOT_ALLOWED,
+        httpx.codes.NOT_IMPLEMENTED,
+    }
+)
+
+
+def _parse_retry_after(retry_after: None | str) -> None | float:
+    """Get the delay in seconds from a Retry-After header (seconds or HTTP date)."""
+    if retry_after is None:
+        return None
+    if retry_after.strip().isdigit():
+        return float(retry_after)
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def _parse_batch_response(
+    response: httpx.Response,
+) -> None | list[Result[bytes, ErrorResult]]:
+    """Get the result of every diagram of a batch, in the order of the request."""
+    try:
+        diagrams = response.json()["diagrams"]
+        results: list[Result[bytes, ErrorResult]] = []
+        for diagram in diagrams:
+            status = diagram["status"]
+            if status == httpx.codes.OK:
+                results.append(Ok(base64.b64decode(diagram["content"])))
+            elif status == httpx.codes.BAD_REQUEST:
+                results.append(
+                    Err(
+                        ErrorResult(
+                            err_msg="Diagram error!", response_text=diagram.get("error")
+                        )
+                    )
+                )
+            else:
+                results.append(
+                    Err(
+                        ErrorResult(
+                            err_msg=f"Could not retrieve image data, got: {diagram.get('error')} [{status}]"
+                        )
+                    )
+                )
+    except (ValueError, TypeError, KeyError) as error:
+        log.info("Invalid batch response: %s", error)
+        return None
+
+    return results
+
+
+@dataclass
+class _BatchItem:
+    kroki_context: KrokiImageContext
+    file_ext: str
+    future: asyncio.Future[Result[bytes, ErrorResult]]
+
 
 class DownloadedContent:
     def __init__(
-        self, file_content: bytes, file_extension: str, additional_metadata: None | dict
+        self, file_content: bytes, file_extension: str, content_key: str
     ) -> None:
-        file_uuid = uuid3(NAMESPACE_OID, f"{additional_metadata}{file_content!r}")
-
-        self.file_name = f"{FILE_PREFIX}{file_uuid}.{file_extension}"
+        # the cache key already identifies the content, no need to hash the
+        # (possibly large) image data again
+        self.file_name = f"{FILE_PREFIX}{content_key[:32]}.{file_extension}"
         self.file_content = file_content
+        self.file_extension = file_extension
+        self.content_key = content_key
 
-    def save(self, context: MkDocsEventContext) -> None:
-        # wherever MkDocs wants to host or build, we plant the image next
-        # to the generated static page
-        page_abs_dest_dir = path.dirname(context.page.file.abs_dest_path)
-        makedirs(page_abs_dest_dir, exist_ok=True)
+    def _write(self, file_path: str) -> bool:
+        """Write the content unless the file already has it, returns if it was written."""
+        makedirs(path.dirname(file_path), exist_ok=True)
+        try:
+            if path.getsize(file_path) == len(self.file_content):
+                with open(file_path, "rb") as file:
+                    if file.read() == self.file_content:
+                        return False
+        except OSError:
+            pass  # not there (yet), write it
+
+        # replace the file at once, so file watchers see a complete file
+        tmp_file_path = f"{file_path}.tmp"
+        with open(tmp_file_path, "wb") as file:
+            file.write(self.file_content)
+        replace(tmp_file_path, file_path)
+        return True
+
+    def _register(
+        self, context: MkDocsEventContext, shared_dir: None | str
+    ) -> tuple[str, None | str]:
+        """Register the content as a MkDocs file of the page.
+
+        Returns:
+            The URL of the file, relative to the page, and the path to write
+            the content to, None if the file is already registered
+        """
+        page_dest_uri_dir = posixpath.dirname(context.page.file.dest_uri)
+        if shared_dir is None:
+            # wherever MkDocs wants to host or build, we plant the image next
+            # to the generated static page
+            abs_dest_dir = path.dirname(context.page.file.abs_dest_path)
+            src_uri_dir = posixpath.dirname(context.page.file.src_uri)
+            dest_uri_dir = page_dest_uri_dir
+        else:
+            # every unique image is stored once for all pages
+            abs_dest_dir = path.join(context.config.site_dir, shared_dir)
+            src_uri_dir = dest_uri_dir = shared_dir
+
+        file_src_uri = posixpath.join(src_uri_dir, self.file_name)
+        file_dest_uri = posixpath.join(dest_uri_dir, self.file_name)
+        file_url = posixpath.relpath(file_dest_uri, page_dest_uri_dir or ".")
+
+        context.saved_files.append(
+            SavedFile(self.content_key, self.file_extension, shared_dir)
+        )
 
-        file_path = path.join(page_abs_dest_dir, self.file_name)
+        known_file = context.files.get_file_from_path(file_src_uri)
+        if known_file is not None and known_file.dest_uri == file_dest_uri:
+            log.debug("Already saved: %s", file_dest_uri)
+            return file_url, None
 
-        log.debug("Saving downloaded data: %s", file_path)
-        with open(file_path, "wb") as file:
-            file.write(self.file_content)
+        file_path = path.join(abs_dest_dir, self.file_name)
 
         # make MkDocs believe that the file was present from the beginning
-        file_src_uri = path.join(
-            path.dirname(context.page.file.src_uri), self.file_name
-        )
-        file_dest_uri = path.join(
-            path.dirname(context.page.file.dest_uri), self.file_name
-        )
-
         dummy_file = MkDocsFile(
             path=file_src_uri,
             src_dir="",
@@ -64,6 +200,58 @@ class DownloadedContent:
         log.debug("Appending dummy mkdocs file: %s", dummy_file)
         context.files.append(dummy_file)
 
+        return file_url, file_path
+
+    @staticmethod
+    def _count_write(written: bool, stats: None | BuildStats) -> None:
+        if stats is None:
+            return
+        if written:
+            stats.written_files += 1
+        else:
+            stats.unchanged_files += 1
+
+    def save(
+        self,
+        context: MkDocsEventContext,
+        shared_dir: None | str = None,
+        stats: None | BuildStats = None,
+    ) -> str:
+        """Save the content to the site and register it as a MkDocs file.
+
+        Args:
+            context: The page including the content
+            shared_dir: Optional directory in the site, shared by all pages
+            stats: Optional counters of written and unchanged files
+
+        Returns:
+            The URL of the saved file, relative to the page
+        """
+        file_url, file_path = self._register(context, shared_dir)
+        if file_path is not None:
+            log.debug("Saving downloaded data: %s", file_path)
+            self._count_write(self._write(file_path), stats)
+
+        return file_url
+
+    async def save_in_executor(
+        self,
+        executor: ThreadPoolExecutor,
+        context: MkDocsEventContext,
+        shared_dir: None | str = None,
+        stats: None | BuildStats = None,
+    ) -> str:
+        """Like `save`, but the file is written in a thread of the executor."""
+        file_url, file_path = self._register(context, shared_dir)
+        if file_path is not None:
+            log.debug("Saving downloaded data: %s", file_path)
+            written = await asyncio.get_running_loop().run_in_executor(
+                executor, self._write, file_path
+            )
+            self._count_write(written, stats)
+
+        return file_url
+
 
 class KrokiClient:
     def __init__(
@@ -74,32 +262,188 @@ class KrokiClient:
         timeout_seconds: int,
         diagram_types: KrokiDiagramTypes,
         cache: KrokiCache,
+        *,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        http2: bool = False,
+        max_concurrent_requests: int = 20,
+        max_concurrent_requests_per_type: None | dict[str, int] = None,
+        max_retries: int = 0,
+        retry_backoff_seconds: float = 0.5,
+        retry_budget: int = 100,
+        batch_url: None | str = None,
+        batch_size: int = 50,
+        compression_level: int = 9,
+        svg_optimization: str = "off",
+        shared_assets_dir: None | str = None,
+        stats: None | BuildStats = None,
     ) -> None:
         self.server_url = server_url
         self.http_method = http_method
         self.headers = {"User-Agent": user_agent}
         self.timeout_seconds = timeout_seconds
+        self.compression_level = compression_level
+        self.svg_optimization = svg_optimization
         self.diagram_types = diagram_types
         self.cache = cache
+        self.stats = stats or BuildStats()
+        self.shared_assets_dir = (
+            None if shared_assets_dir is None else shared_assets_dir.strip("/")
+        )
+
+        # one connection pool for the whole build, so connections (and TLS
+        # sessions) to the kroki server are reused between diagrams
+        try:
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                ),
+                http2=http2,
+            )
+        except ImportError as error:
+            err_msg = "HTTP/2 support requires: pip install 'httpx[http2]'"
+            raise PluginError(err_msg) from error
+
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        # retries left for the whole build
+        self.retry_budget = retry_budget
+
+        # slow renderers get their own limit, so they can't occupy all slots
+        self._request_semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self._type_semaphores = {
+            kroki_type: asyncio.Semaphore(limit)
+            for kroki_type, limit in (max_concurrent_requests_per_type or {}).items()
+        }
+
+        # diagrams waiting to be sent in one request to the batch endpoint
+        self.batch_url = batch_url
+        self.batch_size = batch_size
+        self._pending_batch: list[_BatchItem] = []
+        self._batch_scheduled = False
+        # cache reads in the I/O threads, their diagrams may still join the batch
+        self._cache_reads = 0
+        self._batch_tasks: set[asyncio.Task] = set()
+        # requests on their way, shared by identical diagrams requested meanwhile
+        self._in_flight: dict[str, asyncio.Task[Result[bytes, ErrorResult]]] = {}
+        # diagrams that could not be prefetched, reported on their pages
+        # without requesting (and retrying) them again
+        self._failed_prefetches: dict[str, Err[ErrorResult]] = {}
+        self._io_executor = ThreadPoolExecutor(
+            max_workers=_IO_THREADS, thread_name_prefix="kroki-io"
+        )
 
         log.debug(
-            "Client initialized [http_method: %s, server_url: %s]",
+            "Client initialized [http_method: %s, server_url: %s, http2: %s]",
             self.http_method,
             self.server_url,
+            http2,
+        )
+
+    async def aclose(self) -> None:
+        """Close the pooled connections to the kroki server and the I/O threads."""
+        await self.http_client.aclose()
+        self._io_executor.shutdown()
+
+    async def run_io(self, func: Callable[..., _T], /, **kwargs: object) -> _T:
+        """Run a blocking function (reading or writing files) in one of the I/O threads."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._io_executor, partial(func, **kwargs)
         )
 
+    @asynccontextmanager
+    async def _request_slot(self, kroki_type: str) -> AsyncIterator[None]:
+        type_semaphore = self._type_semaphores.get(kroki_type)
+        async with type_semaphore or nullcontext(), self._request_semaphore:
+            yield
+
+    def _take_retry(self, attempt: int) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        if self.retry_budget <= 0:
+            log.info("Retry budget of the build is used up, not retrying.")
+            return False
+
+        self.retry_budget -= 1
+        return True
+
+    def _retry_delay(self, attempt: int, retry_after: None | float) -> float:
+        if retry_after is not None:
+            return min(retry_after, _RETRY_MAX_DELAY_SECONDS)
+
+        # exponential backoff with jitter, so retries don't arrive in bursts
+        delay = min(self.retry_backoff_seconds * 2**attempt, _RETRY_MAX_DELAY_SECONDS)
+        return random.uniform(delay / 2, delay)
+
+    async def _post(self, url: str, kroki_context: KrokiImageContext) -> httpx.Response:
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                async with self._request_slot(kroki_context.kroki_type):
+                    response = await self.http_client.post(
+                        url,
+                        headers=self.headers,
+                        json={
+                            "diagram_source": kroki_context.data.unwrap(),
+                            "diagram_options": kroki_context.options,
+                        },
+                        timeout=float(self.timeout_seconds),
+                    )
+            except _RETRY_EXCEPTIONS as error:
+                if not self._take_retry(attempt):
+                    raise
+                log.info("Retrying request [url:%s]: %s", url, error)
+            else:
+                if response.status_code not in _RETRY_STATUS_CODES:
+                    return response
+                if not self._take_retry(attempt):
+                    return response
+                log.info("Retrying request [url:%s]: got %s", url, response.status_code)
+                retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+
+            await asyncio.sleep(self._retry_delay(attempt, retry_after))
+            attempt += 1
+
     def _kroki_url_base(self, kroki_type: str) -> str:
         return f"{self.server_url}/{kroki_type}"
 
     def _get_file_ext(self, kroki_type: str) -> str:
         return self.diagram_types.get_file_ext(kroki_type)
 
-    def _kroki_url_get(
+    async def _encode_diagram_source(self, kroki_context: KrokiImageContext) -> str:
+        # the encoded source does not depend on the options and the file type
+        cache_args: dict[str, Any] = {
+            "diagram_source": kroki_context.data.unwrap(),
+            "diagram_type": kroki_context.kroki_type,
+            "file_ext": f"deflate{self.compression_level}",
+            "options": {},
+        }
+        # the memory tier without waiting for a thread, the file cache of
+        # previous builds is read (and written) in the I/O threads
+        cached_data_param = self.cache.get_from_memory(**cache_args)
+        if cached_data_param is None:
+            cached_data_param = await self.run_io(self.cache.get, **cache_args)
+        if cached_data_param is not None:
+            return cached_data_param.decode()
+
+        start_time = time.thread_time()
+        kroki_data_param = base64.urlsafe_b64encode(
+            zlib.compress(
+                str.encode(kroki_context.data.unwrap()), self.compression_level
+            )
+        )
+        self.stats.encoded_sources += 1
+        self.stats.encoding_seconds += time.thread_time() - start_time
+
+        await self.run_io(self.cache.set, **cache_args, content=kroki_data_param)
+        return kroki_data_param.decode()
+
+    async def _kroki_url_get(
         self, kroki_context: KrokiImageContext
     ) -> Result[ImageSrc, ErrorResult]:
-        kroki_data_param = base64.urlsafe_b64encode(
-            zlib.compress(str.encode(kroki_context.data.unwrap()), 9)
-        ).decode()
+        kroki_data_param = await self._encode_diagram_source(kroki_context)
 
         kroki_query_param = (
             "&".join([f"{k}={v}" for k, v in kroki_context.options.items()])
@@ -116,95 +460,311 @@ class KrokiClient:
         log.debug("Image url: %s", textwrap.shorten(image_url, 50))
         return Ok(ImageSrc(url=image_url, file_ext=file_ext))
 
-    async def _kroki_post(
-        self, kroki_context: KrokiImageContext, context: MkDocsEventContext
-    ) -> Result[ImageSrc, ErrorResult]:
-        file_ext = self._get_file_ext(kroki_context.kroki_type)
-
-        # Check cache first
-        cached_content = self.cache.get(
-            diagram_source=kroki_context.data.unwrap(),
-            diagram_type=kroki_context.kroki_type,
-            file_ext=file_ext,
-            options=kroki_context.options,
-        )
+    def _get_response_content(
+        self, response: httpx.Response
+    ) -> Result[bytes, ErrorResult]:
+        if response.status_code == httpx.codes.OK:
+            return Ok(response.content)
 
-        if cached_content is not None:
-            # Use cached content
-            downloaded_image = DownloadedContent(
-                cached_content,
-                file_ext,
-                kroki_context.options,
+        if response.status_code == httpx.codes.BAD_REQUEST:
+            return Err(
+                ErrorResult(err_msg="Diagram error!", response_text=response.text)
             )
-            downloaded_image.save(context)
-            return Ok(
-                ImageSrc(
-                    url=downloaded_image.file_name,
-                    file_ext=file_ext,
-                    file_content=downloaded_image.file_content,
-                )
+
+        return Err(
+            ErrorResult(
+                err_msg=f"Could not retrieve image data, got: {response.reason_phrase} [{response.status_code}]"
             )
+        )
 
-        # Cache miss - fetch from server
+    async def _request_content(
+        self, kroki_context: KrokiImageContext, file_ext: str
+    ) -> Result[bytes, ErrorResult]:
         kroki_endpoint = self._kroki_url_base(kroki_context.kroki_type)
         url = f"{kroki_endpoint}/{file_ext}"
 
         log.debug("POST %s", textwrap.shorten(url, 50))
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
+            response = await self._post(url, kroki_context)
+        except httpx.HTTPError as error:
+            return Err(
+                ErrorResult(err_msg=f"Request error [url:{url}]: {error}", error=error)
+            )
+
+        return self._get_response_content(response)
+
+    def _send_pending_batch(self) -> None:
+        self._batch_scheduled = False
+        batch, self._pending_batch = self._pending_batch, []
+        if not batch:
+            return
+
+        # keep a reference, so the task is not garbage collected while running
+        batch_task = asyncio.ensure_future(self._send_batch(batch))
+        self._batch_tasks.add(batch_task)
+        batch_task.add_done_callback(self._batch_tasks.discard)
+
+    def _schedule_pending_batch(self) -> None:
+        if self._batch_scheduled or self._cache_reads or not self._pending_batch:
+            return
+
+        # the diagrams requested concurrently are added until the event loop
+        # gets to this callback
+        self._batch_scheduled = True
+        asyncio.get_running_loop().call_soon(self._send_pending_batch)
+
+    async def _read_cache(self, cache_args: dict[str, Any]) -> None | bytes:
+        self._cache_reads += 1
+        try:
+            cached_content = await self.run_io(self.cache.get, **cache_args)
+        finally:
+            self._cache_reads -= 1
+
+        # scheduled after the request started by a cache miss, which adds its
+        # diagram to the batch first (not when the read was cancelled, the
+        # event loop may not run anymore)
+        asyncio.get_running_loop().call_soon(self._schedule_pending_batch)
+        return cached_content
+
+    async def _request_batched_content(
+        self, kroki_context: KrokiImageContext, file_ext: str
+    ) -> Result[bytes, ErrorResult]:
+        batch_item = _BatchItem(
+            kroki_context=kroki_context,
+            file_ext=file_ext,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self._pending_batch.append(batch_item)
+        if len(self._pending_batch) >= self.batch_size:
+            self._send_pending_batch()
+        else:
+            self._schedule_pending_batch()
+
+        return await batch_item.future
+
+    async def _request_individually(self, batch: list[_BatchItem]) -> None:
+        results = await asyncio.gather(
+            *(
+                self._request_content(item.kroki_context, item.file_ext)
+                for item in batch
+            )
+        )
+        for item, result in zip(batch, results, strict=True):
+            item.future.set_result(result)
+
+    async def _post_batch(
+        self, url: str, batch: list[_BatchItem]
+    ) -> None | list[Result[bytes, ErrorResult]]:
+        log.debug("POST %s [diagrams: %d]", url, len(batch))
+        try:
+            async with self._request_semaphore:
+                response = await self.http_client.post(
                     url,
                     headers=self.headers,
                     json={
-                        "diagram_source": kroki_context.data.unwrap(),
-                        "diagram_options": kroki_context.options,
+                        "diagrams": [
+                            {
+                                "diagram_type": item.kroki_context.kroki_type,
+                                "output_format": item.file_ext,
+                                "diagram_source": item.kroki_context.data.unwrap(),
+                                "diagram_options": item.kroki_context.options,
+                            }
+                            for item in batch
+                        ]
                     },
                     timeout=float(self.timeout_seconds),
                 )
         except httpx.HTTPError as error:
-            return Err(
-                ErrorResult(err_msg=f"Request error [url:{url}]: {error}", error=error)
-            )
+            log.info("Batch request failed [url:%s]: %s", url, error)
+            return None
 
-        if response.status_code == httpx.codes.OK:
-            # Store in cache
-            self.cache.set(
-                diagram_source=kroki_context.data.unwrap(),
-                diagram_type=kroki_context.kroki_type,
-                file_ext=file_ext,
-                options=kroki_context.options,
-                content=response.content,
+        if response.status_code in _BATCH_UNSUPPORTED_STATUS_CODES:
+            log.info(
+                "Batch rendering is not supported [url:%s], requesting diagrams one by one.",
+                url,
             )
+            self.batch_url = None
+            return None
+        if response.status_code != httpx.codes.OK:
+            log.info("Batch request failed [url:%s]: got %s", url, response.status_code)
+            return None
+
+        results = _parse_batch_response(response)
+        if results is not None and len(results) != len(batch):
+            log.info("Invalid batch response [url:%s]: diagrams missing", url)
+            return None
+        return results
+
+    async def _send_batch(self, batch: list[_BatchItem]) -> None:
+        try:
+            results = None
+            if self.batch_url is not None:
+                results = await self._post_batch(self.batch_url, batch)
+            if results is None:
+                await self._request_individually(batch)
+                return
+
+            for item, result in zip(batch, results, strict=True):
+                item.future.set_result(result)
+        except Exception as error:  # noqa: BLE001 - handed to the waiting requests
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(error)
+
+    async def _fetch_content(
+        self, kroki_context: KrokiImageContext, file_ext: str
+    ) -> Result[bytes, ErrorResult]:
+        cache_args = self._get_cache_args(kroki_context, file_ext)
+        cache_key = get_cache_key(**cache_args)
+        failed_prefetch = self._failed_prefetches.get(cache_key)
+        if failed_prefetch is not None:
+            return failed_prefetch
+
+        # Check cache first, the memory tier without waiting for a thread
+        cached_content = self.cache.get_from_memory(**cache_args)
+        if cached_content is None:
+            cached_content = await self._read_cache(cache_args)
+        if cached_content is not None:
+            return Ok(cached_content)
 
-            downloaded_image = DownloadedContent(
-                response.content,
-                file_ext,
-                kroki_context.options,
-            )
-            downloaded_image.save(context)
-            return Ok(
-                ImageSrc(
-                    url=downloaded_image.file_name,
-                    file_ext=file_ext,
-                    file_content=downloaded_image.file_content,
-                )
+        # Cache miss - fetch from server, unless the same diagram is on its way
+        in_flight_request = self._in_flight.get(cache_key)
+        if in_flight_request is not None:
+            self.stats.coalesced_requests += 1
+            return await in_flight_request
+
+        in_flight_request = asyncio.ensure_future(
+            self._request_and_cache(kroki_context, file_ext)
+        )
+        self._in_flight[cache_key] = in_flight_request
+        in_flight_request.add_done_callback(
+            lambda _request: self._in_flight.pop(cache_key, None)
+        )
+        return await in_flight_request
+
+    def _get_cache_args(
+        self, kroki_context: KrokiImageContext, file_ext: str
+    ) -> dict[str, Any]:
+        options = kroki_context.options
+        if file_ext == "svg" and self.svg_optimization != "off":
+            # optimized diagrams are cached apart from the downloaded ones
+            options = {**options, "svg_optimization": self.svg_optimization}
+        return {
+            "diagram_source": kroki_context.data.unwrap(),
+            "diagram_type": kroki_context.kroki_type,
+            "file_ext": file_ext,
+            "options": options,
+        }
+
+    async def _optimize_svg(self, svg_data: bytes) -> bytes:
+        # large diagrams take a while, requests go on meanwhile
+        optimized_svg_data = await self.run_io(
+            optimize_svg, svg_data=svg_data, level=self.svg_optimization
+        )
+        self.stats.optimized_svgs += 1
+        self.stats.svg_bytes_saved += len(svg_data) - len(optimized_svg_data)
+        return optimized_svg_data
+
+    async def _request_and_cache(
+        self, kroki_context: KrokiImageContext, file_ext: str
+    ) -> Result[bytes, ErrorResult]:
+        if self.batch_url is None:
+            content_result = await self._request_content(kroki_context, file_ext)
+        else:
+            content_result = await self._request_batched_content(
+                kroki_context, file_ext
             )
 
-        if response.status_code == httpx.codes.BAD_REQUEST:
-            return Err(
-                ErrorResult(err_msg="Diagram error!", response_text=response.text)
+        if isinstance(content_result, Ok):
+            if file_ext == "svg" and self.svg_optimization != "off":
+                content_result = Ok(await self._optimize_svg(content_result.ok_value))
+            # Store in cache
+            await self.run_io(
+                self.cache.set,
+                **self._get_cache_args(kroki_context, file_ext),
+                content=content_result.ok_value,
             )
 
-        return Err(
-            ErrorResult(
-                err_msg=f"Could not retrieve image data, got: {response.reason_phrase} [{response.status_code}]"
+        return content_result
+
+    async def _kroki_post(
+        self, kroki_context: KrokiImageContext, context: MkDocsEventContext
+    ) -> Result[ImageSrc, ErrorResult]:
+        file_ext = self._get_file_ext(kroki_context.kroki_type)
+
+        fetch_result = await self._fetch_content(kroki_context, file_ext)
+        if isinstance(fetch_result, Err):
+            return fetch_result
+
+        content_key = get_cache_key(**self._get_cache_args(kroki_context, file_ext))
+        downloaded_image = DownloadedContent(
+            fetch_result.ok_value, file_ext, content_key
+        )
+        return Ok(
+            ImageSrc(
+                url=await downloaded_image.save_in_executor(
+                    self._io_executor, context, self.shared_assets_dir, self.stats
+                ),
+                file_ext=file_ext,
+                file_content=downloaded_image.file_content,
+                content_key=content_key,
             )
         )
 
+    async def read_cached_html(self, cached_html: CachedHtml) -> None | str:
+        """Read the inlined SVG of a block of a previous build from the cache."""
+        svg_data = await self.run_io(
+            self.cache.get_by_key, cache_key=cached_html.cache_key, file_ext="html"
+        )
+        return None if svg_data is None else svg_data.decode()
+
+    async def restore_file(
+        self, saved_file: SavedFile, context: MkDocsEventContext
+    ) -> bool:
+        """Save a file of a previous build again, with its content from the cache.
+
+        Returns:
+            Whether the content was still cached
+        """
+        file_content = await self.run_io(
+            self.cache.get_by_key,
+            cache_key=saved_file.content_key,
+            file_ext=saved_file.file_ext,
+        )
+        if file_content is None:
+            return False
+
+        downloaded_content = DownloadedContent(
+            file_content, saved_file.file_ext, saved_file.content_key
+        )
+        await downloaded_content.save_in_executor(
+            self._io_executor, context, saved_file.shared_dir, self.stats
+        )
+        return True
+
+    async def prefetch(self, kroki_context: KrokiImageContext) -> bool:
+        """Download the diagram into the cache without saving it next to a page.
+
+        Failures are remembered, the pages including the diagram report them
+        without requesting it again.
+
+        Returns:
+            Whether the diagram is available from the cache afterwards
+        """
+        if self.http_method == "GET" or kroki_context.data.is_err():
+            return False
+
+        file_ext = self._get_file_ext(kroki_context.kroki_type)
+        fetch_result = await self._fetch_content(kroki_context, file_ext)
+        if isinstance(fetch_result, Err):
+            cache_key = get_cache_key(**self._get_cache_args(kroki_context, file_ext))
+            self._failed_prefetches[cache_key] = fetch_result
+        return fetch_result.is_ok()
+
     async def get_image_url(
         self, kroki_context: KrokiImageContext, context: MkDocsEventContext
     ) -> Result[ImageSrc, ErrorResult]:
         if self.http_method == "GET":
-            return self._kroki_url_get(kroki_context)
+            return await self._kroki_url_get(kroki_context)
 
         return await self._kroki_post(kroki_context, context)
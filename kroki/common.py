@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Final
 
 from mkdocs.config.defaults import MkDocsConfig as _MkDocsConfig
@@ -27,6 +27,27 @@ class ImageSrc:
     url: str
     file_ext: str
     file_content: None | bytes = None
+    # the cache key of the content, if it was downloaded
+    content_key: None | str = None
+
+
+@dataclass(frozen=True)
+class SavedFile:
+    """A downloaded file saved to the site, the content is kept in the cache only."""
+
+    content_key: str
+    file_ext: str
+    # the directory shared by all pages, if any
+    shared_dir: None | str = None
+
+
+@dataclass(frozen=True)
+class CachedHtml:
+    """An inlined SVG of a block, the element is kept in the cache only."""
+
+    cache_key: str
+    # the mark of `deduplicate_svgs`, if any
+    svg_key: None | str = None
 
 
 @dataclass
@@ -36,6 +57,21 @@ class ErrorResult:
     response_text: None | str = None
 
 
+@dataclass
+class BuildStats:
+    """Counters reported at the end of the build."""
+
+    written_files: int = 0
+    unchanged_files: int = 0
+    skipped_pages: int = 0
+    reused_blocks: int = 0
+    coalesced_requests: int = 0
+    encoded_sources: int = 0
+    encoding_seconds: float = 0.0
+    optimized_svgs: int = 0
+    svg_bytes_saved: int = 0
+
+
 @dataclass
 class MkDocsEventContext:
     """Data supplied by MkDocs on the currently handled page."""
@@ -43,6 +79,13 @@ class MkDocsEventContext:
     page: MkDocsPage
     config: MkDocsConfig
     files: MkDocsFiles
+    # the files saved for the diagrams
+    saved_files: list[SavedFile] = field(default_factory=list)
+    # the inlined SVG of the diagram, if it is cached
+    cached_html: None | CachedHtml = None
+    render_failed: bool = False
+    # absolute paths of the files included with @from_file
+    included_paths: set[str] = field(default_factory=set)
 
 
 @dataclass
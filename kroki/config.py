@@ -5,9 +5,11 @@ from mkdocs.config.base import (
     ConfigErrors as MkDocsConfigErrors,
     ConfigWarnings as MkDocsConfigWarnings,
     Config as MkDocsBaseConfig,
+    ValidationError as MkDocsValidationError,
 )
 
 from kroki import __version__
+from kroki.cache import KrokiCache
 from kroki.logging import log
 
 
@@ -22,17 +24,68 @@ class KrokiPluginConfig(MkDocsBaseConfig):
     enable_diagramsnet = config_options.Type(bool, default=False)
     http_method = config_options.Choice(choices=["GET", "POST"], default="GET")
     request_timeout = config_options.Type(int, default=30)
+    max_connections = config_options.Type(int, default=100)
+    max_keepalive_connections = config_options.Type(int, default=20)
+    http2 = config_options.Type(bool, default=False)
+    max_concurrent_requests = config_options.Type(int, default=20)
+    max_concurrent_requests_per_type = config_options.Type(dict, default={})
+    max_retries = config_options.Type(int, default=0)
+    retry_backoff_seconds = config_options.Type((int, float), default=0.5)
+    retry_budget = config_options.Type(int, default=100)
+    batch_url = config_options.Optional(config_options.URL())
+    batch_size = config_options.Type(int, default=50)
+    compression_level = config_options.Type(int, default=9)
     user_agent = config_options.Type(str, default=f"{__name__}/{__version__}")
     fence_prefix = config_options.Type(str, default="kroki-")
     file_types = config_options.Type(list, default=["svg"])
     file_type_overrides = config_options.Type(dict, default={})
     tag_format = config_options.Choice(choices=["img", "object", "svg"], default="img")
+    deduplicate_svgs = config_options.Type(bool, default=False)
+    image_size_attributes = config_options.Type(bool, default=True)
+    image_loading = config_options.Choice(choices=["lazy", "eager"], default="lazy")
+    image_decoding = config_options.Choice(
+        choices=["async", "sync", "auto"], default="async"
+    )
+    svg_optimization = config_options.Choice(
+        choices=["off", "safe", "aggressive"], default="off"
+    )
     fail_fast = config_options.Type(bool, default=False)
     cache_dir = config_options.Optional(config_options.Type(str))
+    cache_memory_limit_mb = config_options.Type(
+        int, default=KrokiCache.DEFAULT_MEMORY_LIMIT_MB
+    )
+    cache_ttl_days = config_options.Type(
+        (int, float), default=KrokiCache.CACHE_TTL_SECONDS / (24 * 60 * 60)
+    )
+    cache_max_size_mb = config_options.Optional(config_options.Type(int))
+    prefetch_diagrams = config_options.Type(bool, default=False)
+    shared_assets_dir = config_options.Optional(config_options.Type(str))
     download_dir = config_options.Deprecated(removed=True)
 
     def validate(self) -> tuple[MkDocsConfigErrors, MkDocsConfigWarnings]:
         result = super().validate()
+        errors, _warnings = result
+
+        limits = [
+            ("max_concurrent_requests", self["max_concurrent_requests"]),
+            ("batch_size", self["batch_size"]),
+        ]
+        if isinstance(self["max_concurrent_requests_per_type"], dict):
+            limits.extend(
+                (f"max_concurrent_requests_per_type.{kroki_type}", limit)
+                for kroki_type, limit in self[
+                    "max_concurrent_requests_per_type"
+                ].items()
+            )
+        for key, limit in limits:
+            if not isinstance(limit, int) or limit < 1:
+                err_msg = f"Expected a positive integer, got: {limit!r}"
+                errors.append((key, MkDocsValidationError(err_msg)))
+
+        compression_level = self["compression_level"]
+        if isinstance(compression_level, int) and not 0 <= compression_level <= 9:
+            err_msg = f"Expected an integer from 0 to 9, got: {compression_level!r}"
+            errors.append(("compression_level", MkDocsValidationError(err_msg)))
 
         if self["tag_format"] == "svg" and self["http_method"] != "POST":
             log.info("Setting Http method to POST to retrieve svg data for inlining.")
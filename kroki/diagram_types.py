@@ -115,6 +115,10 @@ class KrokiDiagramTypes:
             for diagram_type in diagram_type_file_ext_map
         }
 
+    @property
+    def fence_prefix(self) -> str:
+        return self._fence_prefix
+
     def get_file_ext(self, kroki_type: str) -> str:
         return self._file_ext_mapping[kroki_type]
 
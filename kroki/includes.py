@@ -0,0 +1,105 @@
+import os
+from dataclasses import dataclass
+
+from kroki.logging import log
+
+
+@dataclass(slots=True)
+class _FileContent:
+    mtime_ns: int
+    size: int
+    content: str
+
+
+class IncludedFiles:
+    """Contents of the files included with `@from_file:` and the pages including them.
+
+    A file is read once and kept until its modification time or size
+    changes, so files included by many pages (or unchanged between the
+    rebuilds of `mkdocs serve`) are not read again.
+    """
+
+    def __init__(self) -> None:
+        self._contents: dict[str, _FileContent] = {}
+        self._pages_by_file: dict[str, set[str]] = {}
+        self._files_by_page: dict[str, set[str]] = {}
+
+    def read(self, file_path: str) -> str:
+        """Get the content of a file, reading it only if it changed.
+
+        Raises:
+            OSError: If the file cannot be read
+        """
+        stat = os.stat(file_path)
+        file_content = self._contents.get(file_path)
+        if (
+            file_content is not None
+            and file_content.mtime_ns == stat.st_mtime_ns
+            and file_content.size == stat.st_size
+        ):
+            return file_content.content
+
+        log.debug('Reading kroki block from file: "%s"', file_path)
+        with open(file_path) as data_file:
+            content = data_file.read()
+        self._contents[file_path] = _FileContent(
+            mtime_ns=stat.st_mtime_ns, size=stat.st_size, content=content
+        )
+        return content
+
+    def _is_changed(self, file_path: str) -> bool:
+        file_content = self._contents.get(file_path)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return file_content is not None
+
+        return (
+            file_content is None
+            or file_content.mtime_ns != stat.st_mtime_ns
+            or file_content.size != stat.st_size
+        )
+
+    def set_page_includes(self, page_uri: str, file_paths: set[str]) -> None:
+        """Record the files included by a page, replacing the previous ones."""
+        for file_path in self._files_by_page.pop(page_uri, set()) - file_paths:
+            including_pages = self._pages_by_file[file_path]
+            including_pages.discard(page_uri)
+            if not including_pages:
+                del self._pages_by_file[file_path]
+                self._contents.pop(file_path, None)
+
+        if file_paths:
+            self._files_by_page[page_uri] = file_paths
+        for file_path in file_paths:
+            self._pages_by_file.setdefault(file_path, set()).add(page_uri)
+
+    def get_including_pages(self, file_path: str) -> set[str]:
+        """Get the pages including a file, as URIs relative to the docs dir."""
+        return set(self._pages_by_file.get(file_path, ()))
+
+    def get_include_graph(self) -> dict[str, set[str]]:
+        """Get the files included by every page, pages without includes are left out."""
+        return {
+            page_uri: set(file_paths)
+            for page_uri, file_paths in self._files_by_page.items()
+        }
+
+    def get_included_files(self) -> set[str]:
+        return set(self._pages_by_file)
+
+    def get_changed_files(self) -> set[str]:
+        """Get the included files that were changed, created or removed since they were read."""
+        return {
+            file_path
+            for file_path in self._pages_by_file
+            if self._is_changed(file_path)
+        }
+
+    def get_dirty_pages(self, changed_files: set[str]) -> set[str]:
+        """Get the pages that include any of the changed files."""
+        dirty_pages: set[str] = set()
+        for file_path in changed_files:
+            dirty_pages.update(self._pages_by_file.get(file_path, ()))
+
+        return dirty_pages
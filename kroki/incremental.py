@@ -0,0 +1,114 @@
+import hashlib
+from dataclasses import dataclass
+
+from kroki.client import KrokiClient
+from kroki.common import (
+    CachedHtml,
+    KrokiImageContext,
+    MkDocsEventContext,
+    MkDocsFiles,
+    SavedFile,
+)
+from kroki.svg import set_svg_key
+
+
+def get_block_fingerprint(kroki_context: KrokiImageContext) -> str:
+    """Identify a kroki block by its diagram type, options and source.
+
+    Args:
+        kroki_context: The context of a block with successfully read source
+
+    Returns:
+        A hex string fingerprint
+    """
+    fingerprint_data = (
+        f"{kroki_context.kroki_type}:{sorted(kroki_context.options.items())}:"
+        f"{sorted(kroki_context.plugin_options.items())}:"
+        f"{kroki_context.data.unwrap()}"
+    )
+    return hashlib.sha256(fingerprint_data.encode()).hexdigest()
+
+
+@dataclass
+class RenderedBlock:
+    """The HTML of a rendered kroki block and the files it refers to."""
+
+    # None for inlined SVGs, which are read from the cache
+    html: None | str
+    saved_files: list[SavedFile]
+    cached_html: None | CachedHtml = None
+
+    async def restore(
+        self, context: MkDocsEventContext, kroki_client: KrokiClient
+    ) -> None | str:
+        """Register the files of the block for the current build again.
+
+        The cache is read and the files are written in the I/O threads of the
+        client.
+
+        Returns:
+            The HTML of the block, or None if it or a file is not cached anymore
+        """
+        html = self.html
+        if self.cached_html is not None:
+            html = await kroki_client.read_cached_html(self.cached_html)
+            if html is None:
+                return None
+            if self.cached_html.svg_key is not None:
+                html = set_svg_key(html, self.cached_html.svg_key)
+
+        for saved_file in self.saved_files:
+            if not await kroki_client.restore_file(saved_file, context):
+                return None
+
+        return html
+
+
+class PageRecords:
+    """Rendered kroki blocks of every page, kept between the builds of `mkdocs serve`.
+
+    Blocks whose fingerprint did not change since the previous build are
+    reused without requesting the kroki server. Only the HTML is kept, the
+    content of their files and their inlined SVGs are read from the cache
+    again.
+    """
+
+    def __init__(self) -> None:
+        self._config_key: None | str = None
+        self._pages: dict[str, dict[str, RenderedBlock]] = {}
+        self.kroki_client: None | KrokiClient = None
+
+    def reset_on_config_change(
+        self, config_key: str, kroki_client: KrokiClient
+    ) -> None:
+        """Forget all pages if the configuration differs from the previous build.
+
+        Args:
+            config_key: Identifies the configuration of the build
+            kroki_client: The client of the build, restoring the files of
+                reused blocks from its cache
+        """
+        self.kroki_client = kroki_client
+        if config_key != self._config_key:
+            self._config_key = config_key
+            self._pages.clear()
+
+    def prune(self, files: MkDocsFiles) -> None:
+        """Forget the pages that were deleted or renamed since the previous build."""
+        page_uris = {file.src_uri for file in files.documentation_pages()}
+        for page_uri in self._pages.keys() - page_uris:
+            del self._pages[page_uri]
+
+    async def restore_block(
+        self, rendered_block: RenderedBlock, context: MkDocsEventContext
+    ) -> None | str:
+        """Restore a block of the previous build, None if it has to be rendered again."""
+        if self.kroki_client is None:
+            return None
+        return await rendered_block.restore(context, self.kroki_client)
+
+    def get_blocks(self, page_uri: str) -> dict[str, RenderedBlock]:
+        return self._pages.get(page_uri, {})
+
+    def set_blocks(self, page_uri: str, blocks: dict[str, RenderedBlock]) -> None:
+        self._pages[page_uri] = blocks
@@ -1,55 +1,253 @@
 import asyncio
 import re
 import textwrap
-from collections.abc import Awaitable, Callable
-from pathlib import Path
+from collections.abc import Awaitable, Callable, Iterator
+from dataclasses import dataclass, replace
+from os import path
 from typing import Final
 
 from result import Err, Ok, Result
 
 from kroki.common import (
     PLUGIN_OPTIONS,
+    BuildStats,
     ErrorResult,
     KrokiImageContext,
     MkDocsEventContext,
 )
 from kroki.diagram_types import KrokiDiagramTypes
-from kroki.logging import log
+from kroki.includes import IncludedFiles
+from kroki.incremental import PageRecords, RenderedBlock, get_block_fingerprint
 
-_FENCE_RE = re.compile(
+# the opening line of a fenced block, the closing line is searched separately
+_FENCE_OPENING_RE = re.compile(
     r"(?P<fence>^(?P<indent>[ ]*)(?:````*|~~~~*))[ ]*"
     r"(\.?(?P<lang>[\w#.+-]*)[ ]*)?"
-    r"(?P<opts>\{[^}]*\}|(?:[ ]?[a-zA-Z0-9\-_]+=[a-zA-Z0-9\-_]+)*)\n"
-    r"(?P<code>.*?)(?<=\n)"
-    r"(?P=fence)[ ]*$",
+    r"(?P<opts>\{[^}]*\}|(?:[ ]?[a-zA-Z0-9\-_]+=[a-zA-Z0-9\-_]+)*)\n",
     flags=re.IGNORECASE + re.DOTALL + re.MULTILINE,
 )
+# the language following a fence marker, used to check pages before scanning
+_FENCE_LANG_RE = re.compile(r"[`~]*[ ]*\.?(?P<lang>[\w#.+-]*)")
 _FROM_FILE_PREFIX: Final[str] = "@from_file:"
 
 
+@dataclass(slots=True)
+class FencedBlock:
+    """A fenced code block found in the markdown of a page."""
+
+    start: int
+    end: int
+    indent: str
+    lang: None | str
+    opts: str
+    code: str
+
+    @property
+    def span(self) -> tuple[int, int]:
+        return self.start, self.end
+
+
+def iter_fenced_blocks(markdown: str) -> Iterator[FencedBlock]:
+    """Find all fenced code blocks in a single pass over the markdown.
+
+    Lines that open a block without a matching closing fence are treated as
+    ordinary lines, scanning continues on the next line.
+    """
+    if "```" not in markdown and "~~~" not in markdown:
+        return
+
+    # fences known to have no closing line after the given position
+    unclosed_fences: dict[str, int] = {}
+    pos = 0
+    while (opening := _FENCE_OPENING_RE.search(markdown, pos)) is not None:
+        fence, indent, lang, opts = opening.group("fence", "indent", "lang", "opts")
+        code_start = opening.end()
+        closing_start = -1
+        if unclosed_fences.get(fence, code_start + 1) > code_start:
+            # the first line after the opening line consisting of the fence
+            # and spaces only, code_start is preceded by a line break
+            needle = "\n" + fence
+            found = markdown.find(needle, code_start - 1)
+            while found != -1:
+                closing_end = markdown.find("\n", found + 1)
+                if closing_end == -1:
+                    closing_end = len(markdown)
+                if not markdown[found + len(needle) : closing_end].strip(" "):
+                    closing_start = found + 1
+                    break
+                found = markdown.find(needle, found + 1)
+
+        if closing_start == -1:
+            unclosed_fences[fence] = code_start
+            # not a block, go on with the line after the opening fence
+            pos = markdown.find("\n", opening.start()) + 1
+            continue
+
+        yield FencedBlock(
+            start=opening.start(),
+            end=closing_end,
+            indent=indent,
+            lang=lang,
+            opts=opts,
+            code=markdown[code_start:closing_start],
+        )
+        pos = closing_end
+
+
+def _iter_fence_langs(markdown: str) -> Iterator[str]:
+    """Yield the language after every fence marker, including inline ones.
+
+    This finds a superset of the languages of the fenced blocks, using
+    str.find to skip over the text in between.
+    """
+    for marker in ("```", "~~~"):
+        pos = markdown.find(marker)
+        while pos != -1:
+            end = pos + len(marker)
+            lang_match = _FENCE_LANG_RE.match(markdown, end)
+            if lang_match is not None:
+                yield lang_match.group("lang")
+                end = lang_match.end()
+            pos = markdown.find(marker, end)
+
+
 class MarkdownParser:
-    def __init__(self, docs_dir: str, diagram_types: KrokiDiagramTypes) -> None:
+    def __init__(
+        self,
+        docs_dir: str,
+        diagram_types: KrokiDiagramTypes,
+        event_loop: asyncio.AbstractEventLoop | None = None,
+        stats: BuildStats | None = None,
+        page_records: PageRecords | None = None,
+        included_files: IncludedFiles | None = None,
+    ) -> None:
         self.diagram_types = diagram_types
         self.docs_dir = docs_dir
+        self.event_loop = event_loop
+        self.stats = BuildStats() if stats is None else stats
+        self.page_records = page_records
+        self.included_files = (
+            IncludedFiles() if included_files is None else included_files
+        )
+
+    def _may_contain_kroki_blocks(self, markdown: str) -> bool:
+        fence_prefix = self.diagram_types.fence_prefix
+        if fence_prefix and fence_prefix not in markdown:
+            return False
 
-    def _get_block_content(self, block_data: str) -> Result[str, ErrorResult]:
+        return any(
+            self.diagram_types.get_kroki_type(lang) is not None
+            for lang in _iter_fence_langs(markdown)
+        )
+
+    def _get_block_content(
+        self, block_data: str, included_paths: set[str] | None = None
+    ) -> Result[str, ErrorResult]:
         if not block_data.startswith(_FROM_FILE_PREFIX):
             return Ok(block_data)
 
         file_name = block_data.removeprefix(_FROM_FILE_PREFIX).strip()
-        file_path = Path(self.docs_dir) / file_name
-        log.debug('Reading kroki block from file: "%s"', file_path.absolute())
+        file_path = path.abspath(path.join(self.docs_dir, file_name))
+        if included_paths is not None:
+            included_paths.add(file_path)
         try:
-            with open(file_path) as data_file:
-                return Ok(data_file.read())
+            return Ok(self.included_files.read(file_path))
         except OSError as error:
             return Err(
                 ErrorResult(
-                    err_msg=f'Can\'t read file: "{file_path.absolute()}" from code block "{block_data}"',
+                    err_msg=f'Can\'t read file: "{file_path}" from code block "{block_data}"',
                     error=error,
                 )
             )
 
+    def _get_kroki_context(
+        self, block: FencedBlock, included_paths: set[str] | None = None
+    ) -> KrokiImageContext | None:
+        kroki_type = self.diagram_types.get_kroki_type(block.lang)
+        if kroki_type is None:
+            # Skip not supported code blocks
+            return None
+
+        kroki_options = block.opts
+        options = {}
+        plugin_options = {}
+        if kroki_options:
+            # Strip curly braces if present and parse key=value pairs
+            opts_str = kroki_options.strip().strip("{}")
+            for x in opts_str.split():
+                if "=" in x and not x.startswith("kroki="):
+                    key, value = x.split("=", 1)
+                    if key in PLUGIN_OPTIONS:
+                        plugin_options[key] = value
+                    else:
+                        options[key] = value
+
+        return KrokiImageContext(
+            kroki_type=kroki_type,
+            options=options,
+            plugin_options=plugin_options,
+            data=self._get_block_content(textwrap.dedent(block.code), included_paths),
+        )
+
+    def _gather(self, tasks: list[Awaitable[str]]) -> list[str]:
+        async def _gather_tasks() -> list[str]:
+            return await asyncio.gather(*tasks)
+
+        if self.event_loop is None:
+            return asyncio.run(_gather_tasks())
+
+        # reuse the event loop that lives as long as the build
+        return self.event_loop.run_until_complete(_gather_tasks())
+
+    def get_kroki_contexts(self, markdown: str) -> list[KrokiImageContext]:
+        """Collect the contexts of all kroki blocks without rendering them."""
+        kroki_contexts: list[KrokiImageContext] = []
+        if not self._may_contain_kroki_blocks(markdown):
+            return kroki_contexts
+
+        for block in iter_fenced_blocks(markdown):
+            kroki_context = self._get_kroki_context(block)
+            if kroki_context is not None:
+                kroki_contexts.append(kroki_context)
+
+        return kroki_contexts
+
+    async def _render_block(
+        self,
+        page_records: PageRecords,
+        kroki_context: KrokiImageContext,
+        block_callback: Callable[
+            [KrokiImageContext, MkDocsEventContext], Awaitable[str]
+        ],
+        context: MkDocsEventContext,
+        previous_blocks: dict[str, RenderedBlock],
+        rendered_blocks: dict[str, RenderedBlock],
+    ) -> str:
+        if kroki_context.data.is_err():
+            return await block_callback(kroki_context, context)
+
+        fingerprint = get_block_fingerprint(kroki_context)
+        rendered_block = previous_blocks.get(fingerprint)
+        if rendered_block is not None:
+            html = await page_records.restore_block(rendered_block, context)
+            if html is not None:
+                self.stats.reused_blocks += 1
+                rendered_blocks[fingerprint] = rendered_block
+                return html
+
+        # collect the files saved for this block only
+        block_context = replace(
+            context, saved_files=[], cached_html=None, render_failed=False
+        )
+        html = await block_callback(kroki_context, block_context)
+        if not block_context.render_failed:
+            rendered_blocks[fingerprint] = RenderedBlock(
+                html=None if block_context.cached_html is not None else html,
+                saved_files=block_context.saved_files,
+                cached_html=block_context.cached_html,
+            )
+        return html
+
     def replace_kroki_blocks(
         self,
         markdown: str,
@@ -58,70 +256,60 @@ class MarkdownParser:
         ],
         context: MkDocsEventContext,
     ) -> str:
-        # Collect all matches and their contexts
-        matches = list(_FENCE_RE.finditer(markdown))
-        if not matches:
+        if not self._may_contain_kroki_blocks(markdown):
+            # Pages without diagrams are handed back untouched
+            self.stats.skipped_pages += 1
             return markdown
 
-        # Process matches to build kroki contexts
-        tasks: list[Awaitable[str]] = []
-        match_data: list[tuple[re.Match[str], KrokiImageContext | None]] = []
-        for match_obj in matches:
-            kroki_type = self.diagram_types.get_kroki_type(match_obj.group("lang"))
-            if kroki_type is None:
-                # Skip not supported code blocks
-                match_data.append((match_obj, None))
-                continue
-
-            kroki_options = match_obj.group("opts")
-            options = {}
-            plugin_options = {}
-            if kroki_options:
-                # Strip curly braces if present and parse key=value pairs
-                opts_str = kroki_options.strip().strip("{}")
-                for x in opts_str.split():
-                    if "=" in x and not x.startswith("kroki="):
-                        key, value = x.split("=", 1)
-                        if key in PLUGIN_OPTIONS:
-                            plugin_options[key] = value
-                        else:
-                            options[key] = value
-
-            kroki_context = KrokiImageContext(
-                kroki_type=kroki_type,
-                options=options,
-                plugin_options=plugin_options,
-                data=self._get_block_content(textwrap.dedent(match_obj.group("code"))),
-            )
-            match_data.append((match_obj, kroki_context))
-            tasks.append(block_callback(kroki_context, context))
+        # Collect the kroki blocks in page order, other blocks stay as they are
+        kroki_blocks: list[FencedBlock] = []
+        kroki_contexts: list[KrokiImageContext] = []
+        included_paths: set[str] = set()
+        for block in iter_fenced_blocks(markdown):
+            kroki_context = self._get_kroki_context(block, included_paths)
+            if kroki_context is not None:
+                kroki_blocks.append(block)
+                kroki_contexts.append(kroki_context)
 
-        # Run all async tasks
-        async def _gather_tasks():
-            return await asyncio.gather(*tasks)
+        if included_paths:
+            context.included_paths.update(included_paths)
 
-        if tasks:
-            results = asyncio.run(_gather_tasks())
+        if not kroki_blocks:
+            return markdown
+
+        # Run all async tasks
+        if self.page_records is None:
+            results = self._gather(
+                [block_callback(ctx, context) for ctx in kroki_contexts]
+            )
         else:
-            results = []
-
-        # Build replacement map
-        replacements: dict[tuple[int, int], str] = {}
-        result_idx = 0
-        for match, ctx in match_data:
-            if ctx is None:
-                # Not a kroki block, keep original
-                replacements[match.span()] = match.group()
-            else:
-                # Use the async result
-                replacements[match.span()] = textwrap.indent(
-                    results[result_idx], match.group("indent")
-                )
-                result_idx += 1
+            # while serving, blocks unchanged since the previous build are reused
+            page_uri = context.page.file.src_uri
+            previous_blocks = self.page_records.get_blocks(page_uri)
+            rendered_blocks: dict[str, RenderedBlock] = {}
+            results = self._gather(
+                [
+                    self._render_block(
+                        self.page_records,
+                        ctx,
+                        block_callback,
+                        context,
+                        previous_blocks,
+                        rendered_blocks,
+                    )
+                    for ctx in kroki_contexts
+                ]
+            )
+            self.page_records.set_blocks(page_uri, rendered_blocks)
 
-        # Apply replacements in reverse order to maintain positions
-        result = markdown
-        for (start, end), replacement in sorted(replacements.items(), reverse=True):
-            result = result[:start] + replacement + result[end:]
+        # Rebuild the page in one pass from the text between the kroki blocks
+        # and their replacements
+        segments: list[str] = []
+        pos = 0
+        for block, block_result in zip(kroki_blocks, results, strict=True):
+            segments.append(markdown[pos : block.start])
+            segments.append(textwrap.indent(block_result, block.indent))
+            pos = block.end
+        segments.append(markdown[pos:])
 
-        return result
+        return "".join(segments)
@@ -1,13 +1,28 @@
+from collections.abc import Callable
+from os import path, utime
+from typing import Literal
+
+from mkdocs.livereload import LiveReloadServer
 from mkdocs.plugins import BasePlugin as MkDocsBasePlugin
 
 from kroki.cache import KrokiCache
 from kroki.client import KrokiClient
-from kroki.common import MkDocsConfig, MkDocsEventContext, MkDocsFiles, MkDocsPage
+from kroki.common import (
+    BuildStats,
+    MkDocsConfig,
+    MkDocsEventContext,
+    MkDocsFiles,
+    MkDocsPage,
+)
 from kroki.config import KrokiPluginConfig
 from kroki.diagram_types import KrokiDiagramTypes
+from kroki.includes import IncludedFiles
+from kroki.incremental import PageRecords
 from kroki.logging import log
 from kroki.parsing import MarkdownParser
 from kroki.render import ContentRenderer
+from kroki.scheduler import BuildScheduler
+from kroki.svg import deduplicate_svgs
 
 
 class KrokiPlugin(MkDocsBasePlugin[KrokiPluginConfig]):
@@ -16,6 +31,29 @@ class KrokiPlugin(MkDocsBasePlugin[KrokiPluginConfig]):
     kroki_client: KrokiClient
     cache: KrokiCache
     diagram_types: KrokiDiagramTypes
+    scheduler: BuildScheduler
+    stats: BuildStats
+    page_records: None | PageRecords = None
+    included_files: IncludedFiles
+    dirty: bool = False
+    live_reload_server: None | LiveReloadServer = None
+    watched_paths: set[str]
+
+    def __init__(self) -> None:
+        super().__init__()
+        # programmatic builds may not call on_startup
+        self.included_files = IncludedFiles()
+        self.watched_paths = set()
+
+    def on_startup(
+        self, *, command: Literal["build", "gh-deploy", "serve"], dirty: bool
+    ) -> None:
+        # the plugin lives as long as the server, records are kept between builds
+        self.page_records = PageRecords() if command == "serve" else None
+        self.included_files = IncludedFiles()
+        self.dirty = dirty
+        self.live_reload_server = None
+        self.watched_paths = set()
 
     def on_config(self, config: MkDocsConfig) -> MkDocsConfig:
         log.debug("Configuring config: %s", self.config)
@@ -31,8 +69,13 @@ class KrokiPlugin(MkDocsBasePlugin[KrokiPluginConfig]):
             diagramsnet_enabled=self.config.enable_diagramsnet,
         )
 
-        self.cache = KrokiCache(cache_dir=self.config.cache_dir)
-
+        self.stats = BuildStats()
+        self.cache = KrokiCache(
+            cache_dir=self.config.cache_dir,
+            memory_limit_mb=self.config.cache_memory_limit_mb,
+            ttl_seconds=self.config.cache_ttl_days * 24 * 60 * 60,
+            max_size_mb=self.config.cache_max_size_mb,
+        )
         self.kroki_client = KrokiClient(
             server_url=self.config.server_url,
             http_method=self.config.http_method,
@@ -40,16 +83,76 @@ class KrokiPlugin(MkDocsBasePlugin[KrokiPluginConfig]):
             user_agent=self.config.user_agent,
             diagram_types=self.diagram_types,
             cache=self.cache,
+            max_connections=self.config.max_connections,
+            max_keepalive_connections=self.config.max_keepalive_connections,
+            http2=self.config.http2,
+            max_concurrent_requests=self.config.max_concurrent_requests,
+            max_concurrent_requests_per_type=self.config.max_concurrent_requests_per_type,
+            max_retries=self.config.max_retries,
+            retry_backoff_seconds=self.config.retry_backoff_seconds,
+            retry_budget=self.config.retry_budget,
+            batch_url=self.config.batch_url,
+            batch_size=self.config.batch_size,
+            compression_level=self.config.compression_level,
+            svg_optimization=self.config.svg_optimization,
+            shared_assets_dir=self.config.shared_assets_dir,
+            stats=self.stats,
+        )
+        if self.page_records is not None:
+            self.page_records.reset_on_config_change(
+                repr((sorted(self.config.items()), config.use_directory_urls)),
+                self.kroki_client,
+            )
+        self.scheduler = BuildScheduler(self.kroki_client)
+        self.parser = MarkdownParser(
+            config.docs_dir,
+            self.diagram_types,
+            self.scheduler.event_loop,
+            stats=self.stats,
+            page_records=self.page_records,
+            included_files=self.included_files,
         )
-        self.parser = MarkdownParser(config.docs_dir, self.diagram_types)
         self.renderer = ContentRenderer(
             self.kroki_client,
             tag_format=self.config.tag_format,
             fail_fast=self.config.fail_fast,
+            deduplicate_svgs=self.config.deduplicate_svgs,
+            image_size_attributes=self.config.image_size_attributes,
+            image_loading=self.config.image_loading,
+            image_decoding=self.config.image_decoding,
         )
 
         return config
 
+    def _mark_dirty_pages(self, files: MkDocsFiles) -> None:
+        changed_files = self.included_files.get_changed_files()
+        dirty_pages = self.included_files.get_dirty_pages(changed_files)
+        log.debug(
+            "Included files changed: %d, pages to rebuild: %d",
+            len(changed_files),
+            len(dirty_pages),
+        )
+        for page_uri in dirty_pages:
+            page_file = files.get_file_from_path(page_uri)
+            if page_file is None or not path.isfile(page_file.abs_dest_path):
+                continue
+            # MkDocs rebuilds pages whose output is older than their source
+            utime(page_file.abs_dest_path, (0, 0))
+
+    def on_files(self, files: MkDocsFiles, config: MkDocsConfig) -> MkDocsFiles:
+        if self.page_records is not None:
+            self.page_records.prune(files)
+
+        if self.dirty:
+            # dirty builds only handle changed pages, the includes are not
+            # known to MkDocs
+            self._mark_dirty_pages(files)
+
+        if self.config.prefetch_diagrams:
+            self.scheduler.prefetch(files, self.parser)
+
+        return files
+
     def on_page_markdown(
         self,
         markdown: str,
@@ -60,6 +163,95 @@ class KrokiPlugin(MkDocsBasePlugin[KrokiPluginConfig]):
         mkdocs_context = MkDocsEventContext(page=page, config=config, files=files)
         log.debug("on_page_content [%s]", mkdocs_context)
 
-        return self.parser.replace_kroki_blocks(
+        markdown = self.parser.replace_kroki_blocks(
             markdown, self.renderer.render_kroki_block, mkdocs_context
         )
+        if self.config.deduplicate_svgs and self.config.tag_format == "svg":
+            markdown = deduplicate_svgs(markdown)
+        self.included_files.set_page_includes(
+            page.file.src_uri, mkdocs_context.included_paths
+        )
+
+        return markdown
+
+    def _log_build_summary(self) -> None:
+        cache_stats = self.cache.stats
+        log.info(
+            "Cache: %d memory hits, %d file hits, %d misses, %d evictions",
+            cache_stats.memory_hits,
+            cache_stats.file_hits,
+            cache_stats.misses,
+            cache_stats.evictions,
+        )
+        log.info(
+            "Files: %d written, %d unchanged",
+            self.stats.written_files,
+            self.stats.unchanged_files,
+        )
+        if self.config.http_method == "GET":
+            log.info(
+                "URLs: %d diagram sources encoded in %.3fs CPU time",
+                self.stats.encoded_sources,
+                self.stats.encoding_seconds,
+            )
+        if self.config.svg_optimization != "off":
+            log.info(
+                "SVGs: %d optimized, %d bytes saved",
+                self.stats.optimized_svgs,
+                self.stats.svg_bytes_saved,
+            )
+        log.info(
+            "Requests: %d coalesced with identical requests in flight",
+            self.stats.coalesced_requests,
+        )
+        log.info("Pages: %d skipped without diagrams", self.stats.skipped_pages)
+        if self.page_records is not None:
+            log.info(
+                "Diagrams: %d reused from the previous build", self.stats.reused_blocks
+            )
+
+    def _watch_included_files(self) -> None:
+        if self.live_reload_server is None:
+            return
+
+        included_files = self.included_files.get_included_files()
+        for file_path in self.watched_paths - included_files:
+            self.live_reload_server.unwatch(file_path)
+            self.watched_paths.discard(file_path)
+
+        docs_dir = path.abspath(self.parser.docs_dir)
+        for file_path in included_files - self.watched_paths:
+            # the docs dir is watched by MkDocs already
+            if path.commonpath([docs_dir, file_path]) == docs_dir:
+                continue
+            if not path.isfile(file_path):
+                continue
+            self.live_reload_server.watch(file_path, recursive=False)
+            self.watched_paths.add(file_path)
+
+    def on_serve(
+        self,
+        server: LiveReloadServer,
+        /,
+        *,
+        config: MkDocsConfig,
+        builder: Callable,
+    ) -> LiveReloadServer:
+        self.live_reload_server = server
+        self._watch_included_files()
+
+        return server
+
+    def on_post_build(self, config: MkDocsConfig) -> None:
+        self.scheduler.close()
+        self.cache.cleanup()
+        self.cache.flush()
+        self._log_build_summary()
+        # includes found by this build
+        self._watch_included_files()
+
+    def on_build_error(self, error: Exception) -> None:
+        self.scheduler.close()
+
+    def on_shutdown(self) -> None:
+        self.scheduler.close()
@@ -1,12 +1,29 @@
+import asyncio
+import struct
+from typing import Any, Final
 from xml.etree import ElementTree as XmlElementTree
 
 from defusedxml import ElementTree as DefuseElementTree
 from mkdocs.exceptions import PluginError
 from result import Err, Ok
 
+from kroki.cache import get_cache_key
 from kroki.client import KrokiClient
-from kroki.common import ErrorResult, ImageSrc, KrokiImageContext, MkDocsEventContext
+from kroki.common import (
+    CachedHtml,
+    ErrorResult,
+    ImageSrc,
+    KrokiImageContext,
+    MkDocsEventContext,
+)
 from kroki.logging import log
+from kroki.svg import get_svg_size, set_root_attributes, set_svg_key
+
+_PNG_SIGNATURE: Final[bytes] = b"\x89PNG\r\n\x1a\n"
+# JPEG start of frame markers, followed by the image size
+_JPEG_SOF_MARKERS: Final[frozenset[int]] = frozenset(
+    {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+)
 
 
 def _get_object_media_type(file_ext: str) -> str:
@@ -24,6 +41,43 @@ def _get_object_media_type(file_ext: str) -> str:
             raise PluginError(err_msg)
 
 
+def _get_jpeg_size(jpeg_data: bytes) -> None | tuple[int, int]:
+    # segments are walked by their lengths up to the start of frame
+    position = 2
+    while position + 9 <= len(jpeg_data) and jpeg_data[position] == 0xFF:
+        marker = jpeg_data[position + 1]
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", jpeg_data, position + 5)
+            return width, height
+        (segment_length,) = struct.unpack_from(">H", jpeg_data, position + 2)
+        position += 2 + segment_length
+
+    return None
+
+
+def _get_image_size(image_src: ImageSrc) -> None | tuple[int, int]:
+    """Get the width and height of an image from its header, without decoding it."""
+    image_data = image_src.file_content
+    if image_data is None:
+        return None
+
+    match image_src.file_ext:
+        case "png":
+            # the IHDR chunk comes first
+            if len(image_data) < 24 or not image_data.startswith(_PNG_SIGNATURE):
+                return None
+            width, height = struct.unpack_from(">II", image_data, 16)
+            return width, height
+        case "svg":
+            return get_svg_size(image_data)
+        case "jpeg":
+            if not image_data.startswith(b"\xff\xd8"):
+                return None
+            return _get_jpeg_size(image_data)
+        case _:
+            return None
+
+
 class ContentRenderer:
     def __init__(
         self,
@@ -31,15 +85,25 @@ class ContentRenderer:
         tag_format: str,
         *,
         fail_fast: bool,
+        deduplicate_svgs: bool = False,
+        image_size_attributes: bool = True,
+        image_loading: str = "lazy",
+        image_decoding: str = "async",
     ) -> None:
         self.fail_fast = fail_fast
+        self.deduplicate_svgs = deduplicate_svgs
+        self.image_size_attributes = image_size_attributes
+        self.image_loading = image_loading
+        self.image_decoding = image_decoding
         self.kroki_client = kroki_client
         self.tag_format = tag_format
+        # inlined SVGs on their way, shared by identical diagrams meanwhile
+        self._svg_tasks: dict[str, asyncio.Task[str]] = {}
 
     @staticmethod
-    def _build_style_attr(plugin_options: dict) -> str:
-        """Build inline style attribute from plugin options."""
-        styles = []
+    def _build_style_attr(plugin_options: dict, size_styles: list[str]) -> str:
+        """Build inline style attribute from plugin options and the size attributes."""
+        styles = list(size_styles)
         if "display-width" in plugin_options:
             styles.append(f"width: {plugin_options['display-width']}")
         if "display-height" in plugin_options:
@@ -61,19 +125,9 @@ class ContentRenderer:
             return ""
         return f' style="{"; ".join(styles)}"'
 
-    @classmethod
-    def _svg_data(cls, image_src: ImageSrc, plugin_options: dict) -> str:
-        if image_src.file_content is None:
-            err_msg = "Cannot include empty SVG data"
-            raise PluginError(err_msg)
-
-        XmlElementTree.register_namespace("", "http://www.w3.org/2000/svg")
-        XmlElementTree.register_namespace("xlink", "http://www.w3.org/1999/xlink")
-        svg_tag = DefuseElementTree.fromstring(
-            image_src.file_content.decode("UTF-8"),
-        )
-        svg_tag.attrib["preserveAspectRatio"] = "xMaxYMax meet"
-        svg_tag.attrib["id"] = "Kroki"
+    @staticmethod
+    def _svg_root_attributes(plugin_options: dict) -> dict[str, str]:
+        svg_attributes = {"preserveAspectRatio": "xMaxYMax meet", "id": "Kroki"}
 
         # Build inline style for display options
         styles = []
@@ -82,11 +136,109 @@ class ContentRenderer:
         if "display-height" in plugin_options:
             styles.append(f"height: {plugin_options['display-height']}")
         if styles:
-            svg_tag.attrib["style"] = "; ".join(styles)
+            svg_attributes["style"] = "; ".join(styles)
+
+        return svg_attributes
+
+    @staticmethod
+    def _parsed_svg_data(svg_data: str, svg_attributes: dict[str, str]) -> str:
+        XmlElementTree.register_namespace("", "http://www.w3.org/2000/svg")
+        XmlElementTree.register_namespace("xlink", "http://www.w3.org/1999/xlink")
+        svg_tag = DefuseElementTree.fromstring(svg_data)
+        svg_tag.attrib.update(svg_attributes)
 
         return DefuseElementTree.tostring(svg_tag, short_empty_elements=True).decode()
 
-    def _image_response(self, image_src: ImageSrc, plugin_options: dict) -> str:
+    @classmethod
+    def _svg_data(cls, image_src: ImageSrc, plugin_options: dict) -> str:
+        if image_src.file_content is None:
+            err_msg = "Cannot include empty SVG data"
+            raise PluginError(err_msg)
+
+        svg_data = image_src.file_content.decode("UTF-8")
+        svg_attributes = cls._svg_root_attributes(plugin_options)
+        # only the root tag is rewritten, unless the document needs a parser
+        # (which rejects entity declarations)
+        svg_element = set_root_attributes(svg_data, svg_attributes)
+        if svg_element is None:
+            svg_element = cls._parsed_svg_data(svg_data, svg_attributes)
+
+        return svg_element
+
+    def _build_size_attrs(
+        self, image_src: ImageSrc, plugin_options: dict
+    ) -> tuple[str, list[str]]:
+        """Build width and height attributes, so browsers reserve the space of the image.
+
+        Returns:
+            The attributes and the styles keeping the aspect ratio, when a
+            theme limits the width (like `max-width: 100%`) but not the height
+        """
+        if not self.image_size_attributes:
+            return "", []
+        # display options set the size with CSS, mixing both would distort it
+        if "display-width" in plugin_options or "display-height" in plugin_options:
+            return "", []
+
+        image_size = _get_image_size(image_src)
+        if image_size is None:
+            return "", []
+        width, height = image_size
+        # objects don't derive the aspect ratio from their attributes
+        return f' width="{width}" height="{height}"', [
+            "height: auto",
+            f"aspect-ratio: {width} / {height}",
+        ]
+
+    def _get_svg_cache_args(
+        self, content_key: str, plugin_options: dict
+    ) -> dict[str, Any]:
+        # the inlined SVG of the same content and options, from this or a
+        # previous build
+        return {
+            "diagram_source": content_key,
+            "diagram_type": self.tag_format,
+            "file_ext": "html",
+            "options": plugin_options,
+        }
+
+    async def _cached_svg_data(self, image_src: ImageSrc, plugin_options: dict) -> str:
+        if image_src.content_key is None:
+            return self._svg_data(image_src, plugin_options)
+
+        cache = self.kroki_client.cache
+        cache_args = self._get_svg_cache_args(image_src.content_key, plugin_options)
+        svg_data = cache.get_from_memory(**cache_args)
+        if svg_data is not None:
+            return svg_data.decode()
+
+        svg_key = get_cache_key(**cache_args)
+        svg_task = self._svg_tasks.get(svg_key)
+        if svg_task is None:
+            svg_task = asyncio.ensure_future(
+                self._load_svg_data(image_src, plugin_options, cache_args)
+            )
+            self._svg_tasks[svg_key] = svg_task
+            svg_task.add_done_callback(lambda _task: self._svg_tasks.pop(svg_key, None))
+        return await svg_task
+
+    async def _load_svg_data(
+        self, image_src: ImageSrc, plugin_options: dict, cache_args: dict[str, Any]
+    ) -> str:
+        cache = self.kroki_client.cache
+        svg_data = await self.kroki_client.run_io(cache.get, **cache_args)
+        if svg_data is not None:
+            return svg_data.decode()
+
+        svg_element = self._svg_data(image_src, plugin_options)
+        await self.kroki_client.run_io(
+            cache.set, **cache_args, content=svg_element.encode()
+        )
+        return svg_element
+
+    async def _image_response(
+        self, image_src: ImageSrc, plugin_options: dict, context: MkDocsEventContext
+    ) -> str:
         tag_format = self.tag_format
         if tag_format == "svg":
             if image_src.file_ext != "svg":
@@ -98,16 +250,42 @@ class ContentRenderer:
                 log.warning("Cannot render missing data in svg tag -> using img tag.")
                 tag_format = "img"
 
-        style_attr = self._build_style_attr(plugin_options)
-
         match tag_format:
             case "object":
                 media_type = _get_object_media_type(image_src.file_ext)
-                return f'<object id="Kroki" type="{media_type}" data="{image_src.url}"{style_attr}></object>'
+                size_attrs, size_styles = self._build_size_attrs(
+                    image_src, plugin_options
+                )
+                style_attr = self._build_style_attr(plugin_options, size_styles)
+                return f'<object id="Kroki" type="{media_type}" data="{image_src.url}"{size_attrs}{style_attr}></object>'
             case "svg":
-                return ContentRenderer._svg_data(image_src, plugin_options)
+                svg_element = await self._cached_svg_data(image_src, plugin_options)
+                if image_src.content_key is None:
+                    return svg_element
+
+                svg_key = None
+                if self.deduplicate_svgs:
+                    svg_key = image_src.content_key[:16]
+                    svg_element = set_svg_key(svg_element, svg_key)
+                # the records of `mkdocs serve` read the element from the cache
+                context.cached_html = CachedHtml(
+                    get_cache_key(
+                        **self._get_svg_cache_args(
+                            image_src.content_key, plugin_options
+                        )
+                    ),
+                    svg_key,
+                )
+                return svg_element
             case "img":
-                return f'<img alt="Kroki" src="{image_src.url}"{style_attr} />'
+                size_attrs, size_styles = self._build_size_attrs(
+                    image_src, plugin_options
+                )
+                style_attr = self._build_style_attr(plugin_options, size_styles)
+                loading_attrs = (
+                    f' loading="{self.image_loading}" decoding="{self.image_decoding}"'
+                )
+                return f'<img alt="Kroki" src="{image_src.url}"{size_attrs}{loading_attrs}{style_attr} />'
             case _:
                 err_msg = "Unknown tag format set."
                 raise PluginError(err_msg)
@@ -138,10 +316,12 @@ class ContentRenderer:
             case Ok(kroki_data):
                 match await self.kroki_client.get_image_url(kroki_context, context):
                     case Ok(image_src):
-                        return self._image_response(
-                            image_src, kroki_context.plugin_options
+                        return await self._image_response(
+                            image_src, kroki_context.plugin_options, context
                         )
                     case Err(err_result):
+                        context.render_failed = True
                         return self._err_response(err_result, kroki_data)
             case Err(err_result):
+                context.render_failed = True
                 return self._err_response(err_result)
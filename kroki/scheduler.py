@@ -0,0 +1,92 @@
+import asyncio
+import time
+from collections.abc import Iterator
+
+from kroki.client import KrokiClient
+from kroki.common import KrokiImageContext, MkDocsFiles
+from kroki.logging import log
+from kroki.parsing import MarkdownParser
+
+
+class BuildScheduler:
+    """Owns the event loop used for all Kroki requests of a build.
+
+    Optionally all diagrams of the site are requested concurrently before
+    MkDocs handles the first page, so the pages are served from the cache.
+    """
+
+    def __init__(self, kroki_client: KrokiClient) -> None:
+        self.kroki_client = kroki_client
+        self.event_loop = asyncio.new_event_loop()
+
+    @staticmethod
+    def _read_page_sources(files: MkDocsFiles) -> Iterator[str]:
+        for file in files.documentation_pages():
+            if file.abs_src_path is None:
+                continue
+            try:
+                with open(file.abs_src_path, encoding="utf-8-sig") as page_file:
+                    yield page_file.read()
+            except OSError as error:
+                log.debug("Could not read page for prefetching: %s", error)
+
+    def _collect_kroki_contexts(
+        self, files: MkDocsFiles, parser: MarkdownParser
+    ) -> list[KrokiImageContext]:
+        unique_contexts: dict[tuple, KrokiImageContext] = {}
+        for markdown in self._read_page_sources(files):
+            for kroki_context in parser.get_kroki_contexts(markdown):
+                if kroki_context.data.is_err():
+                    continue
+                key = (
+                    kroki_context.kroki_type,
+                    kroki_context.data.unwrap(),
+                    tuple(sorted(kroki_context.options.items())),
+                )
+                unique_contexts.setdefault(key, kroki_context)
+
+        return list(unique_contexts.values())
+
+    def prefetch(self, files: MkDocsFiles, parser: MarkdownParser) -> None:
+        """Render the diagrams of all pages into the cache at once."""
+        kroki_contexts = self._collect_kroki_contexts(files, parser)
+        if not kroki_contexts:
+            return
+
+        async def _gather_prefetches() -> list[bool]:
+            return await asyncio.gather(
+                *(self.kroki_client.prefetch(ctx) for ctx in kroki_contexts)
+            )
+
+        start_time = time.perf_counter()
+        results = self.event_loop.run_until_complete(_gather_prefetches())
+        log.info(
+            "Prefetched %d of %d diagrams in %.2fs",
+            sum(results),
+            len(kroki_contexts),
+            time.perf_counter() - start_time,
+        )
+
+    def _cancel_pending_tasks(self) -> None:
+        # e.g. the renderings of a page left behind by a fail-fast error
+        pending_tasks = asyncio.all_tasks(self.event_loop)
+        if not pending_tasks:
+            return
+
+        for task in pending_tasks:
+            task.cancel()
+        self.event_loop.run_until_complete(
+            asyncio.gather(*pending_tasks, return_exceptions=True)
+        )
+
+    def close(self) -> None:
+        """Cancel the pending tasks, close the connection pool of the client and the event loop."""
+        if self.event_loop.is_closed():
+            return
+
+        try:
+            self._cancel_pending_tasks()
+            self.event_loop.run_until_complete(self.kroki_client.aclose())
+            self.event_loop.run_until_complete(self.event_loop.shutdown_asyncgens())
+        finally:
+            self.event_loop.close()
@@ -0,0 +1,365 @@
+import re
+from dataclasses import dataclass
+from html import escape
+from typing import Final
+
+# what may precede the root tag: a byte order mark, whitespace, the XML
+# declaration, processing instructions, comments and a doctype without
+# internal subset
+_PROLOG_RE: Final[re.Pattern[str]] = re.compile(
+    r"""\ufeff?(?:\s+|<\?.*?\?>|<!--.*?-->|<!DOCTYPE(?:[^>\["']|"[^"]*"|'[^']*')*>)*""",
+    re.DOTALL,
+)
+_ROOT_TAG_RE: Final[re.Pattern[str]] = re.compile(
+    r"""<svg(?P<attributes>(?:\s+[^\s=/>"']+\s*=\s*(?:"[^"<]*"|'[^'<]*'))*)\s*(?P<end>/?>)"""
+)
+_ATTRIBUTE_RE: Final[re.Pattern[str]] = re.compile(
+    r"""\s+(?P<name>[^\s=/>"']+)\s*=\s*(?P<quote>["'])(?P<value>(?:(?!(?P=quote))[^<])*)(?P=quote)"""
+)
+
+
+def set_root_attributes(svg_data: str, attributes: dict[str, str]) -> None | str:
+    """Set attributes of the root tag of an SVG without parsing the whole document.
+
+    Only the prolog and the root tag are looked at, everything after the root
+    tag is copied as it is. The prolog is dropped, as it is not allowed in
+    HTML.
+
+    Args:
+        svg_data: The SVG document
+        attributes: The attributes to set, replacing existing values
+
+    Returns:
+        The SVG element, or None if the document has to be parsed, as the
+        prolog or the root tag is not a plain `<svg>` tag (e.g. a doctype with
+        an internal subset, which may declare entities)
+    """
+    prolog = _PROLOG_RE.match(svg_data)
+    root_tag = _ROOT_TAG_RE.match(svg_data, prolog.end() if prolog else 0)
+    if root_tag is None:
+        return None
+
+    kept_attributes = [
+        attribute.group()
+        for attribute in _ATTRIBUTE_RE.finditer(root_tag["attributes"])
+        if attribute["name"] not in attributes
+    ]
+    new_attributes = [
+        f' {name}="{escape(value)}"' for name, value in attributes.items()
+    ]
+    return (
+        f"<svg{''.join(kept_attributes)}{''.join(new_attributes)}{root_tag['end']}"
+        f"{svg_data[root_tag.end() :]}"
+    )
+
+
+@dataclass(frozen=True)
+class _Optimization:
+    # decimals of coordinates and lengths
+    precision: int
+    # whitespace between tags is removed, instead of indentation only
+    strip_whitespace: bool
+
+
+_OPTIMIZATIONS: Final[dict[str, _Optimization]] = {
+    "safe": _Optimization(precision=3, strip_whitespace=False),
+    "aggressive": _Optimization(precision=2, strip_whitespace=True),
+}
+_START_TAG_RE: Final[re.Pattern[str]] = re.compile(r"<[A-Za-z][^<>]*>")
+# parts of the document, only the tags within text elements (and HTML in
+# foreign objects) are changed, as whitespace in there is displayed
+_OPTIMIZATION_TOKEN_RE: Final[re.Pattern[str]] = re.compile(
+    r"""(?P<cdata><!\[CDATA\[.*?\]\]>)"""
+    r"""|(?P<comment>(?:(?<=>)\s+)?<!--.*?-->)"""
+    r"""|(?P<metadata>(?:(?<=>)\s+)?<metadata\b[^>]*?(?:/>|>.*?</metadata>))"""
+    r"""|(?P<text><text\b.*?</text>|<foreignObject\b.*?</foreignObject>)"""
+    rf"""|(?P<tag>{_START_TAG_RE.pattern})"""
+    r"""|(?<=>)(?P<whitespace>\s+)(?=<)""",
+    re.DOTALL,
+)
+# transforms are left alone, as rounding scale factors and rotations changes
+# the size and position of everything within them
+_NUMERIC_ATTRIBUTE_RE: Final[re.Pattern[str]] = re.compile(
+    r"""(?<=\s)(?P<name>d|points|viewBox|x[12]?|y[12]?|dx|dy|cx|cy|r|rx|ry"""
+    r"""|width|height|stroke-width|font-size)=(?P<quote>["'])(?P<value>[^"']*)(?P=quote)"""
+)
+_NUMBER_CHARS: Final[str] = "0123456789."
+_NUMBER_RE: Final[re.Pattern[str]] = re.compile(
+    r"-?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?"
+)
+
+
+def _round_decimals(value: str, precision: int) -> str:
+    def round_decimal(number_match: re.Match[str]) -> str:
+        number = number_match.group()
+        decimals = len(number) - number.find(".") - 1
+        if "." not in number or "e" in number.lower() or decimals <= precision:
+            return number
+        # numbers written without separator are left alone, as in "1.5.5"
+        # or "1e-1.5", the rounded number could merge with its neighbor
+        start, end = number_match.span()
+        if value[end : end + 1] == "." or (
+            start > 0 and number[0] != "-" and value[start - 1] in _NUMBER_CHARS
+        ):
+            return number
+
+        rounded = f"{float(number):.{precision}f}".rstrip("0").rstrip(".")
+        return "0" if rounded == "-0" else rounded
+
+    return _NUMBER_RE.sub(round_decimal, value)
+
+
+def optimize_svg(svg_data: bytes, level: str) -> bytes:
+    """Make an SVG smaller without changing how it is displayed.
+
+    Comments and metadata are removed, coordinates and lengths are rounded
+    and indentation between tags is dropped (with `aggressive`, all
+    whitespace between tags outside of text elements).
+
+    Args:
+        svg_data: The SVG document
+        level: How much to change, `safe` or `aggressive`
+
+    Returns:
+        The optimized SVG document, or the given one if it is not UTF-8
+    """
+    optimization = _OPTIMIZATIONS[level]
+    try:
+        svg_text = svg_data.decode("UTF-8")
+    except UnicodeDecodeError:
+        return svg_data
+
+    def optimize_token(token: re.Match[str]) -> str:
+        if token["comment"] is not None or token["metadata"] is not None:
+            return ""
+        if token["whitespace"] is not None:
+            if optimization.strip_whitespace:
+                return ""
+            return "\n" if "\n" in token["whitespace"] else token["whitespace"]
+        if token["tag"] is not None:
+            return _NUMERIC_ATTRIBUTE_RE.sub(round_attribute, token["tag"])
+        if token["text"] is not None:
+            return _START_TAG_RE.sub(round_tag, token["text"])
+        return token.group()
+
+    def round_tag(tag: re.Match[str]) -> str:
+        return _NUMERIC_ATTRIBUTE_RE.sub(round_attribute, tag.group())
+
+    def round_attribute(attribute: re.Match[str]) -> str:
+        value = _round_decimals(attribute["value"], optimization.precision)
+        return f"{attribute['name']}={attribute['quote']}{value}{attribute['quote']}"
+
+    return _OPTIMIZATION_TOKEN_RE.sub(optimize_token, svg_text).encode()
+
+
+# marks the inlined SVGs of a page to deduplicate, with their content key
+SVG_KEY_ATTRIBUTE: Final[str] = "data-kroki-svg"
+# added to the deduplicated SVGs, as their IDs are numbered
+SVG_CLASS: Final[str] = "kroki"
+_KEYED_SVG_RE: Final[re.Pattern[str]] = re.compile(
+    rf'<svg {SVG_KEY_ATTRIBUTE}="(?P<key>[0-9a-f]+)"'
+)
+_SVG_BOUNDARY_RE: Final[re.Pattern[str]] = re.compile(r"<svg\b|</svg>")
+_ID_ATTRIBUTE_RE: Final[re.Pattern[str]] = re.compile(
+    r"""(?<=\s)id=(?P<quote>["'])(?P<id>[^"']*)(?P=quote)"""
+)
+_ID_REFERENCE_RE: Final[re.Pattern[str]] = re.compile(
+    r"""(?P<prefix>url\(\s*["']?#|href=["']#)(?P<id>[^"')\s]+)"""
+)
+
+
+def set_svg_key(svg_element: str, svg_key: str) -> str:
+    """Mark an inlined SVG element for `deduplicate_svgs`."""
+    return f'<svg {SVG_KEY_ATTRIBUTE}="{svg_key}"{svg_element.removeprefix("<svg")}'
+
+
+def _find_svg_end(html: str, svg_start: int) -> None | tuple[int, int]:
+    """Get the span of the end tag of the SVG element starting at the position."""
+    depth = 0
+    for boundary in _SVG_BOUNDARY_RE.finditer(html, svg_start):
+        depth += 1 if boundary.group() == "<svg" else -1
+        if depth == 0:
+            return boundary.span()
+
+    return None
+
+
+def _prefix_ids(svg_content: str, id_prefix: str) -> str:
+    """Prefix the IDs of the elements and the references to them."""
+
+    def prefix_id_attribute(tag: re.Match[str]) -> str:
+        return _ID_ATTRIBUTE_RE.sub(
+            lambda id_attribute: (
+                f"id={id_attribute['quote']}{id_prefix}{id_attribute['id']}"
+                f"{id_attribute['quote']}"
+            ),
+            tag.group(),
+        )
+
+    def prefix_id_reference(reference: re.Match[str]) -> str:
+        if reference["id"] not in ids:
+            return reference.group()
+        return f"{reference['prefix']}{id_prefix}{reference['id']}"
+
+    ids = {
+        id_attribute["id"] for id_attribute in _ID_ATTRIBUTE_RE.finditer(svg_content)
+    }
+    if not ids:
+        return svg_content
+
+    svg_content = _START_TAG_RE.sub(prefix_id_attribute, svg_content)
+    return _ID_REFERENCE_RE.sub(prefix_id_reference, svg_content)
+
+
+def _set_unique_id(root_attributes: dict[str, str], svg_key: str, number: int) -> None:
+    """Number the ID of an SVG element and add the class."""
+    # values of single quoted attributes may contain double quotes
+    id_attribute = _ATTRIBUTE_RE.fullmatch(root_attributes.get("id", ""))
+    if id_attribute is not None:
+        svg_id = id_attribute["value"].replace('"', "&quot;")
+        root_attributes["id"] = f' id="{svg_id}-{svg_key}-{number}"'
+
+    class_attribute = _ATTRIBUTE_RE.fullmatch(root_attributes.get("class", ""))
+    if class_attribute is None:
+        root_attributes["class"] = f' class="{SVG_CLASS}"'
+    elif SVG_CLASS not in class_attribute["value"].split():
+        svg_class = class_attribute["value"].replace('"', "&quot;")
+        root_attributes["class"] = f' class="{svg_class} {SVG_CLASS}"'
+
+
+def deduplicate_svgs(html: str) -> str:
+    """Include the content of repeated SVGs only once, as `<symbol>` used by all of them.
+
+    Only SVG elements marked with `set_svg_key` are changed. The IDs within
+    their content are prefixed with the key and the ID of every SVG element is
+    numbered (e.g. `Kroki-<key>-2`), so they are unique on the page. The
+    elements get the `kroki` class instead, for styling.
+
+    Args:
+        html: The page including the SVG elements
+
+    Returns:
+        The page with the marks removed
+    """
+    keyed_svgs = list(_KEYED_SVG_RE.finditer(html))
+    if not keyed_svgs:
+        return html
+
+    svg_counts: dict[str, int] = {}
+    for keyed_svg in keyed_svgs:
+        svg_counts[keyed_svg["key"]] = svg_counts.get(keyed_svg["key"], 0) + 1
+
+    parts: list[str] = []
+    defined_symbols: set[str] = set()
+    svg_numbers: dict[str, int] = {}
+    position = 0
+    for keyed_svg in keyed_svgs:
+        svg_start = keyed_svg.start()
+        if svg_start < position:
+            continue  # within an SVG handled before
+
+        svg_key = keyed_svg["key"]
+        root_tag = _ROOT_TAG_RE.match(html, svg_start)
+        svg_end = _find_svg_end(html, svg_start)
+        if root_tag is None or root_tag["end"] == "/>" or svg_end is None:
+            # left as it is, without the mark
+            parts.append(f"{html[position:svg_start]}<svg")
+            position = keyed_svg.end()
+            continue
+
+        symbol_id = f"kroki-{svg_key}"
+        root_attributes = {
+            attribute["name"]: attribute.group()
+            for attribute in _ATTRIBUTE_RE.finditer(root_tag["attributes"])
+        }
+        root_attributes.pop(SVG_KEY_ATTRIBUTE)
+        svg_numbers[svg_key] = svg_numbers.get(svg_key, 0) + 1
+        _set_unique_id(root_attributes, svg_key, svg_numbers[svg_key])
+        parts.append(html[position:svg_start])
+        parts.append(f"<svg{''.join(root_attributes.values())}>")
+        if svg_counts[svg_key] == 1:
+            parts.append(
+                _prefix_ids(html[root_tag.end() : svg_end[0]], f"{symbol_id}-")
+            )
+        else:
+            if svg_key not in defined_symbols:
+                defined_symbols.add(svg_key)
+                symbol_attributes = "".join(
+                    root_attributes.get(name, "")
+                    for name in ("viewBox", "preserveAspectRatio")
+                )
+                parts.append(
+                    f'<symbol id="{symbol_id}"{symbol_attributes}>'
+                    f"{_prefix_ids(html[root_tag.end() : svg_end[0]], f'{symbol_id}-')}"
+                    "</symbol>"
+                )
+            parts.append(f'<use href="#{symbol_id}"/>')
+        parts.append("</svg>")
+        position = svg_end[1]
+
+    parts.append(html[position:])
+    return "".join(parts)
+
+
+# the root tag is expected within the beginning of the document
+_SIZE_HEAD_BYTES: Final[int] = 64 * 1024
+_LENGTH_RE: Final[re.Pattern[str]] = re.compile(
+    r"\s*(?P<number>\d+(?:\.\d+)?)(?P<unit>[a-z]*)\s*", re.IGNORECASE
+)
+# CSS pixels per absolute unit, relative units (like `em`) are not known
+_PIXELS_PER_UNIT: Final[dict[str, float]] = {
+    "": 1,
+    "px": 1,
+    "pt": 96 / 72,
+    "pc": 96 / 6,
+    "in": 96,
+    "cm": 96 / 2.54,
+    "mm": 96 / 25.4,
+    "q": 96 / 101.6,
+}
+
+
+def _parse_length(length: None | str) -> None | float:
+    if length is None:
+        return None
+    length_match = _LENGTH_RE.fullmatch(length)
+    if length_match is None:
+        return None
+    pixels_per_unit = _PIXELS_PER_UNIT.get(length_match["unit"].lower())
+    if pixels_per_unit is None:
+        return None
+    return float(length_match["number"]) * pixels_per_unit
+
+
+def get_svg_size(svg_data: bytes) -> None | tuple[int, int]:
+    """Get the width and height of an SVG from its root tag, in pixels.
+
+    Only the beginning of the document is read. Absolute units (like `pt` of
+    Graphviz) are converted to pixels, relative sizes (like `100%` or `em`)
+    fall back to the size of the `viewBox`.
+
+    Returns:
+        The size, or None if it is not known
+    """
+    svg_head = svg_data[:_SIZE_HEAD_BYTES].decode("UTF-8", errors="ignore")
+    prolog = _PROLOG_RE.match(svg_head)
+    root_tag = _ROOT_TAG_RE.match(svg_head, prolog.end() if prolog else 0)
+    if root_tag is None:
+        return None
+
+    root_attributes = {
+        attribute["name"]: attribute["value"]
+        for attribute in _ATTRIBUTE_RE.finditer(root_tag["attributes"])
+    }
+    width = _parse_length(root_attributes.get("width"))
+    height = _parse_length(root_attributes.get("height"))
+    if width is None or height is None:
+        view_box = root_attributes.get("viewBox", "").replace(",", " ").split()
+        try:
+            width, height = (float(length) for length in view_box[2:])
+        except ValueError:
+            return None
+
+    if width <= 0 or height <= 0:
+        return None
+    return round(width), round(height)
@@ -1,5 +1,5 @@
 import tempfile
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import httpx
 import pytest
@@ -7,6 +7,25 @@ import pytest
 from kroki.diagram_types import KrokiDiagramTypes
 
 
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption(
+        "--benchmark", action="store_true", help="run the tests marked as benchmark"
+    )
+
+
+def pytest_collection_modifyitems(
+    config: pytest.Config, items: list[pytest.Item]
+) -> None:
+    """Skip the timing based benchmarks, they are flaky on loaded machines."""
+    if config.getoption("--benchmark"):
+        return
+
+    skip_benchmark = pytest.mark.skip(reason="benchmark, run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
 @pytest.fixture(autouse=True)
 def isolated_cache(monkeypatch):
     """Use a temporary cache directory for each test to avoid cross-test contamination."""
@@ -40,6 +59,7 @@ class MockResponse:
     status_code: int
     content: None | bytes = None
     text: None | str = None
+    headers: dict = field(default_factory=dict)
 
     @property
     def reason_phrase(self) -> str:
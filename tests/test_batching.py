@@ -0,0 +1,194 @@
+import base64
+import json
+import threading
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bs4
+import httpx
+import pytest
+
+from tests.utils import MkDocsHelper, MkDocsTemplateHelper
+
+# requests are disabled for all tests, these go to the local stub server only
+_async_client_request = httpx.AsyncClient.request
+
+
+class StubKrokiServer(ThreadingHTTPServer):
+    """Local kroki server rendering every diagram as an SVG containing its source."""
+
+    def __init__(self, *, batch_supported: bool) -> None:
+        super().__init__(("127.0.0.1", 0), StubKrokiHandler)
+        self.batch_supported = batch_supported
+        self.requests: list[tuple[str, dict]] = []
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def get_request_paths(self) -> list[str]:
+        return [request_path for request_path, _body in self.requests]
+
+
+class StubKrokiHandler(BaseHTTPRequestHandler):
+    server: StubKrokiServer
+
+    @staticmethod
+    def _render(diagram_source: str) -> tuple[int, bytes]:
+        if "error" in diagram_source:
+            return 400, b"Syntax Error"
+        return 200, f"<svg>{diagram_source.strip()}</svg>".encode()
+
+    def _respond(self, status: int, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, body))
+        if self.path != "/batch":
+            self._respond(*self._render(body["diagram_source"]))
+            return
+        if not self.server.batch_supported:
+            self._respond(404, b"Not Found")
+            return
+
+        diagrams = []
+        for diagram in body["diagrams"]:
+            status, content = self._render(diagram["diagram_source"])
+            if status == 200:
+                diagrams.append(
+                    {"status": status, "content": base64.b64encode(content).decode()}
+                )
+            else:
+                diagrams.append({"status": status, "error": content.decode()})
+        self._respond(200, json.dumps({"diagrams": diagrams}).encode())
+
+    def log_message(self, *_args) -> None:
+        pass
+
+
+def _start_stub_server(
+    monkeypatch: pytest.MonkeyPatch, *, batch_supported: bool
+) -> Iterator[StubKrokiServer]:
+    monkeypatch.setattr(
+        "httpx.AsyncClient.request", _async_client_request, raising=False
+    )
+    server = StubKrokiServer(batch_supported=batch_supported)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def stub_server(monkeypatch) -> Iterator[StubKrokiServer]:
+    yield from _start_stub_server(monkeypatch, batch_supported=True)
+
+
+@pytest.fixture
+def stub_server_without_batches(monkeypatch) -> Iterator[StubKrokiServer]:
+    yield from _start_stub_server(monkeypatch, batch_supported=False)
+
+
+def _code_blocks(count: int) -> str:
+    return "\n".join(f"```mermaid\ndiagram {index}\n```\n" for index in range(count))
+
+
+def _configure_batching(
+    mkdocs_helper: MkDocsHelper.Context, server: StubKrokiServer
+) -> None:
+    mkdocs_helper.set_plugin_option("server_url", server.url)
+    mkdocs_helper.set_plugin_option("batch_url", f"{server.url}/batch")
+    mkdocs_helper.set_tag_format("svg")
+
+
+def _get_inline_svg_texts(mkdocs_helper: MkDocsHelper.Context) -> list[str]:
+    with open(mkdocs_helper.test_dir / "site/index.html") as index_html_file:
+        index_soup = bs4.BeautifulSoup(index_html_file.read(), features="html.parser")
+    return [svg.text for svg in index_soup.find_all("svg", attrs={"id": "Kroki"})]
+
+
+def test_diagrams_of_a_page_are_rendered_in_one_request(
+    stub_server: StubKrokiServer,
+) -> None:
+    # Arrange
+    with MkDocsTemplateHelper(_code_blocks(5)) as mkdocs_helper:
+        _configure_batching(mkdocs_helper, stub_server)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert stub_server.get_request_paths() == ["/batch"]
+        (_path, body) = stub_server.requests[0]
+        assert [diagram["diagram_type"] for diagram in body["diagrams"]] == [
+            "mermaid"
+        ] * 5
+        assert _get_inline_svg_texts(mkdocs_helper) == [
+            f"diagram {index}" for index in range(5)
+        ]
+
+
+def test_batches_are_limited_by_batch_size(stub_server: StubKrokiServer) -> None:
+    # Arrange
+    with MkDocsTemplateHelper(_code_blocks(5)) as mkdocs_helper:
+        _configure_batching(mkdocs_helper, stub_server)
+        mkdocs_helper.set_plugin_option("batch_size", 2)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert [len(body["diagrams"]) for _path, body in stub_server.requests] == [
+            2,
+            2,
+            1,
+        ]
+        assert _get_inline_svg_texts(mkdocs_helper) == [
+            f"diagram {index}" for index in range(5)
+        ]
+
+
+def test_diagram_errors_of_a_batch_are_reported_per_diagram(
+    stub_server: StubKrokiServer,
+) -> None:
+    # Arrange
+    code_blocks = _code_blocks(2) + "\n```mermaid\nsyntax error\n```\n"
+    with MkDocsTemplateHelper(code_blocks) as mkdocs_helper:
+        _configure_batching(mkdocs_helper, stub_server)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert stub_server.get_request_paths() == ["/batch"]
+        assert _get_inline_svg_texts(mkdocs_helper) == ["diagram 0", "diagram 1"]
+        with open(mkdocs_helper.test_dir / "site/index.html") as index_html_file:
+            assert "Syntax Error" in index_html_file.read()
+
+
+def test_diagrams_are_requested_one_by_one_without_batch_support(
+    stub_server_without_batches: StubKrokiServer,
+) -> None:
+    # Arrange
+    with MkDocsTemplateHelper(_code_blocks(3)) as mkdocs_helper:
+        _configure_batching(mkdocs_helper, stub_server_without_batches)
+        (mkdocs_helper.test_dir / "docs/other.md").write_text(
+            "```mermaid\nother diagram\n```\n"
+        )
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        # the batch endpoint is asked once per build only
+        assert stub_server_without_batches.get_request_paths() == [
+            "/batch",
+            *["/mermaid/svg"] * 4,
+        ]
+        assert _get_inline_svg_texts(mkdocs_helper) == [
+            f"diagram {index}" for index in range(3)
+        ]
@@ -149,10 +149,14 @@ def test_cache_file_naming():
 
         cache.set(diagram_source, diagram_type, file_ext, options, content)
 
-        # Check that a file with .svg extension was created
-        cache_files = list(Path(tmpdir).glob("*.svg"))
+        # Check that a file with .svg extension was created in its shard
+        cache_files = list(Path(tmpdir).rglob("*.svg"))
         assert len(cache_files) == 1
         assert cache_files[0].read_bytes() == content
+        file_name = cache_files[0].name
+        assert (
+            cache_files[0] == Path(tmpdir) / file_name[:2] / file_name[2:4] / file_name
+        )
 
 
 def test_cache_falls_back_to_temp(monkeypatch):
@@ -169,7 +173,7 @@ def test_cache_falls_back_to_temp(monkeypatch):
 
 
 def test_cache_cleanup_old_files():
-    """Test that old cache files are cleaned up on initialization."""
+    """Test that old cache files are cleaned up by the cleanup after the build."""
     import time
 
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -189,17 +193,20 @@ def test_cache_cleanup_old_files():
         recent_time = time.time() - (1 * 24 * 60 * 60)
         os.utime(recent_file, (recent_time, recent_time))
 
-        # Initialize cache, which should trigger cleanup
-        _ = KrokiCache(cache_dir=tmpdir)
+        # Initialize cache and clean up, like after a build
+        cache = KrokiCache(cache_dir=tmpdir)
+        cache.cleanup()
 
         # Old file should be deleted
         assert not old_file.exists()
-        # Recent file should still exist
-        assert recent_file.exists()
+        assert not (cache_dir / "ol" / "d_" / "old_diagram.svg").exists()
+        # Recent file should still exist, migrated to the sharded layout
+        assert not recent_file.exists()
+        assert (cache_dir / "re" / "ce" / "recent_diagram.svg").exists()
 
 
 def test_cache_touches_file_on_read():
-    """Test that cache updates file modification time when reading (LRU strategy)."""
+    """Test that cache updates the access time in the index when reading (LRU strategy)."""
     import time
 
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -214,24 +221,181 @@ def test_cache_touches_file_on_read():
         # Store in cache
         cache.set(diagram_source, diagram_type, file_ext, options, content)
 
-        # Get the cache file path
-        cache_files = list(Path(tmpdir).glob("*.svg"))
+        # Get the cache file name
+        cache_files = list(Path(tmpdir).rglob("*.svg"))
         assert len(cache_files) == 1
-        cache_file = cache_files[0]
+        file_name = cache_files[0].name
 
-        # Get initial modification time
-        initial_mtime = cache_file.stat().st_mtime
+        # Pretend the file was last accessed a day ago
+        initial_access = int(time.time()) - 24 * 60 * 60
+        cache.index.entries[file_name] = (len(content), initial_access)
 
-        # Wait a bit to ensure time difference
-        time.sleep(0.1)
-
-        # Read from cache (should touch the file)
+        # Read from cache (should record the access)
         # Clear in-memory cache first to force file read
         cache.in_memory_cache.clear()
         retrieved = cache.get(diagram_source, diagram_type, file_ext, options)
 
         assert retrieved == content
 
-        # Modification time should be updated
-        new_mtime = cache_file.stat().st_mtime
-        assert new_mtime > initial_mtime
+        # Access time should be updated, also for the next build
+        assert cache.index.entries[file_name][1] > initial_access
+        cache.flush()
+        next_cache = KrokiCache(cache_dir=tmpdir)
+        assert next_cache.index.entries[file_name][1] > initial_access
+
+
+def test_memory_cache_evicts_least_recently_used():
+    """Test that the in-memory cache stays within its size limit."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = KrokiCache(cache_dir=tmpdir)
+        cache.in_memory_cache.max_bytes = 10
+        options = {}
+
+        cache.set("A", "mermaid", "svg", options, b"aaaa")
+        cache.set("B", "mermaid", "svg", options, b"bbbb")
+        # Mark A as recently used
+        assert cache.get("A", "mermaid", "svg", options) == b"aaaa"
+        cache.set("C", "mermaid", "svg", options, b"cccc")
+
+        assert cache.in_memory_cache.size_bytes == 8
+        assert len(cache.in_memory_cache) == 2
+        assert cache.stats.evictions == 1
+
+        # B was evicted from memory, but is still in the file cache
+        assert cache.get("B", "mermaid", "svg", options) == b"bbbb"
+        assert cache.stats.memory_hits == 1
+        assert cache.stats.file_hits == 1
+
+
+def test_memory_cache_skips_oversized_content():
+    """Test that content larger than the memory limit is only stored in the file cache."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = KrokiCache(cache_dir=tmpdir, memory_limit_mb=0)
+        options = {}
+
+        cache.set("A", "mermaid", "svg", options, b"aaaa")
+
+        assert len(cache.in_memory_cache) == 0
+        assert cache.get("A", "mermaid", "svg", options) == b"aaaa"
+        assert cache.get("B", "mermaid", "svg", options) is None
+        assert cache.stats.file_hits == 1
+        assert cache.stats.misses == 1
+
+
+def test_cache_index_avoids_directory_listing(monkeypatch):
+    """Test that an existing index is used instead of scanning the cache directory."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = KrokiCache(cache_dir=tmpdir)
+        cache.set("graph TD; A-->B;", "mermaid", "svg", {}, b"<svg>test</svg>")
+
+        def fail_iterdir(_path):
+            raise AssertionError("cache directory was scanned")
+
+        monkeypatch.setattr(Path, "iterdir", fail_iterdir)
+        cache = KrokiCache(cache_dir=tmpdir)
+
+        assert cache.get("graph TD; A-->B;", "mermaid", "svg", {}) == b"<svg>test</svg>"
+
+
+def test_cache_index_is_compacted():
+    """Test that outdated index lines are dropped when the index is flushed."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = KrokiCache(cache_dir=tmpdir)
+        for _ in range(200):
+            cache.set("graph TD; A-->B;", "mermaid", "svg", {}, b"<svg>test</svg>")
+
+        cache.flush()
+
+        index_lines = (Path(tmpdir) / KrokiCache.INDEX_FILE_NAME).read_text()
+        assert len(index_lines.splitlines()) == 1
+
+
+def test_cache_index_rewrite_keeps_entries_of_other_builds():
+    """Test that a rewrite of the index keeps the lines appended by another build."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = KrokiCache(cache_dir=tmpdir)
+        cache.set("A", "mermaid", "svg", {}, b"<svg>A</svg>")
+        other_cache = KrokiCache(cache_dir=tmpdir)
+        other_cache.set("B", "mermaid", "svg", {}, b"<svg>B</svg>")
+        # Let A expire, so the cleanup rewrites the index
+        file_name_a, *_ = cache.index.entries
+        cache.index.entries[file_name_a] = (len(b"<svg>A</svg>"), 0)
+
+        cache.cleanup()
+
+        next_cache = KrokiCache(cache_dir=tmpdir)
+        assert file_name_a not in next_cache.index
+        assert list(next_cache.index.entries) == list(other_cache.index.entries)[1:]
+        assert next_cache.get("B", "mermaid", "svg", {}) == b"<svg>B</svg>"
+
+
+def test_cache_no_cleanup_on_initialization():
+    """Test that initializing the cache does not remove any files."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = KrokiCache(cache_dir=tmpdir, ttl_seconds=0)
+        cache.set("graph TD; A-->B;", "mermaid", "svg", {}, b"<svg>test</svg>")
+
+        cache = KrokiCache(cache_dir=tmpdir, ttl_seconds=0)
+
+        assert len(list(Path(tmpdir).rglob("*.svg"))) == 1
+
+
+def test_cache_cleanup_enforces_max_size():
+    """Test that the least recently used files are removed beyond the size limit."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = KrokiCache(cache_dir=tmpdir, max_size_mb=1)
+        half_mb = b"x" * (512 * 1024)
+        for diagram_source in ("A", "B", "C"):
+            cache.set(diagram_source, "mermaid", "png", {}, half_mb)
+        # Mark A as least recently used
+        import time
+
+        file_name_a, *_ = cache.index.entries
+        for file_name, (size, _) in cache.index.entries.items():
+            last_access = int(time.time()) - (60 if file_name == file_name_a else 0)
+            cache.index.entries[file_name] = (size, last_access)
+
+        cache.cleanup()
+
+        assert file_name_a not in cache.index
+        assert len(cache.index.entries) == 2
+        assert len(list(Path(tmpdir).rglob("*.png"))) == 2
+
+
+def test_cache_cleanup_resumes_after_time_budget():
+    """Test that a cleanup running out of time leaves the files for the next cleanup."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = KrokiCache(cache_dir=tmpdir, ttl_seconds=-1)
+        cache.set("graph TD; A-->B;", "mermaid", "svg", {}, b"<svg>test</svg>")
+
+        cache.cleanup(time_budget_seconds=-1)
+        assert len(list(Path(tmpdir).rglob("*.svg"))) == 1
+
+        cache = KrokiCache(cache_dir=tmpdir, ttl_seconds=-1)
+        cache.cleanup()
+        assert len(list(Path(tmpdir).rglob("*.svg"))) == 0
+
+
+def test_cache_is_shared_between_threads():
+    """Test that threads writing and reading the same diagrams never see partial files."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writing_cache = KrokiCache(cache_dir=tmpdir, memory_limit_mb=0)
+        content = b"<svg>" + b"x" * (256 * 1024) + b"</svg>"
+
+        def set_and_get(index: int) -> set[bytes | None]:
+            diagram_source = f"graph TD; A-->B{index % 4};"
+            writing_cache.set(diagram_source, "mermaid", "svg", {}, content)
+            reading_cache = KrokiCache(cache_dir=tmpdir, memory_limit_mb=0)
+            return {
+                writing_cache.get(diagram_source, "mermaid", "svg", {}),
+                reading_cache.get(diagram_source, "mermaid", "svg", {}),
+            }
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = set().union(*executor.map(set_and_get, range(32)))
+
+        assert results == {content}
+        assert len(writing_cache.index.entries) == 4
+        assert not list(Path(tmpdir).rglob("*.tmp"))
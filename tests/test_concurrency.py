@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from tests.conftest import MockResponse
+from tests.utils import MkDocsTemplateHelper, get_expected_log_line
+
+
+def _code_blocks(kroki_type: str, count: int) -> str:
+    return "\n".join(
+        f"```{kroki_type}\ndiagram {index}\n```\n" for index in range(count)
+    )
+
+
+@pytest.fixture
+def concurrency_tracker(monkeypatch) -> dict[str, int]:
+    """Let request post calls take a while and track the peak number of parallel calls per diagram type."""
+    running: dict[str, int] = {}
+    peak: dict[str, int] = {}
+
+    async def mock_post(_client, url, **_kwargs):
+        kroki_type = url.split("/")[-2]
+        running[kroki_type] = running.get(kroki_type, 0) + 1
+        running["total"] = running.get("total", 0) + 1
+        peak[kroki_type] = max(peak.get(kroki_type, 0), running[kroki_type])
+        peak["total"] = max(peak.get("total", 0), running["total"])
+        await asyncio.sleep(0.01)
+        running[kroki_type] -= 1
+        running["total"] -= 1
+        return MockResponse(status_code=200, content=b"<svg>dummy data</svg>")
+
+    monkeypatch.setattr("httpx.AsyncClient.post", mock_post)
+    return peak
+
+
+def test_max_concurrent_requests(concurrency_tracker) -> None:
+    # Arrange
+    with MkDocsTemplateHelper(_code_blocks("mermaid", 10)) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_plugin_option("max_concurrent_requests", 3)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert concurrency_tracker["total"] == 3
+
+
+def test_max_concurrent_requests_per_type(concurrency_tracker) -> None:
+    # Arrange
+    code_blocks = _code_blocks("tikz", 6) + _code_blocks("mermaid", 6)
+    with MkDocsTemplateHelper(code_blocks) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_plugin_option("max_concurrent_requests", 4)
+        mkdocs_helper.set_plugin_option("max_concurrent_requests_per_type", {"tikz": 1})
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert concurrency_tracker["tikz"] == 1
+        assert concurrency_tracker["mermaid"] > 1
+        assert concurrency_tracker["total"] <= 4
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_max_concurrent_requests_must_be_positive() -> None:
+    # Arrange
+    with MkDocsTemplateHelper(_code_blocks("mermaid", 1)) as mkdocs_helper:
+        mkdocs_helper.set_plugin_option("max_concurrent_requests", 0)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 1
+        assert "Expected a positive integer, got: 0" in result.output
+
+
+def test_identical_diagrams_share_one_request(monkeypatch) -> None:
+    requested_sources = []
+
+    async def mock_post(_client, _url, **kwargs):
+        requested_sources.append(kwargs["json"]["diagram_source"])
+        await asyncio.sleep(0.01)
+        return MockResponse(status_code=200, content=b"<svg>dummy data</svg>")
+
+    monkeypatch.setattr("httpx.AsyncClient.post", mock_post)
+
+    # Arrange
+    code_blocks = "\n".join([_code_blocks("mermaid", 1)] * 5) + _code_blocks(
+        "plantuml", 1
+    )
+    with MkDocsTemplateHelper(code_blocks) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        # one request for the five identical mermaid diagrams, one for plantuml
+        assert len(requested_sources) == 2
+        assert (
+            get_expected_log_line(
+                "Requests: 4 coalesced with identical requests in flight"
+            )
+            in result.output
+        )
@@ -1,5 +1,6 @@
 import pytest
 
+from tests.conftest import MockResponse
 from tests.utils import MkDocsHelper
 
 
@@ -13,15 +14,13 @@ def test_custom_request_timeout(monkeypatch) -> None:
         nonlocal captured_timeout
         captured_timeout = kwargs.get("timeout")
         # Call the original mock from kroki_dummy fixture
-        from tests.conftest import MockResponse
 
         return MockResponse(status_code=200, content=b"<svg>dummy data</svg>")
 
     # Arrange
     with MkDocsHelper("happy_path") as mkdocs_helper:
         # Add custom timeout to configuration
-        plugin_config = mkdocs_helper._get_plugin_config_entry()
-        plugin_config["request_timeout"] = 25
+        mkdocs_helper.set_plugin_option("request_timeout", 25)
         mkdocs_helper.set_http_method("POST")
 
         # Patch the post method to capture timeout
@@ -46,7 +45,6 @@ def test_default_request_timeout(monkeypatch) -> None:
     async def mock_post_with_timeout_capture(*args, **kwargs):
         nonlocal captured_timeout
         captured_timeout = kwargs.get("timeout")
-        from tests.conftest import MockResponse
 
         return MockResponse(status_code=200, content=b"<svg>dummy data</svg>")
 
@@ -66,3 +64,28 @@ def test_default_request_timeout(monkeypatch) -> None:
         assert captured_timeout == 30.0, (
             f"Expected default timeout to be 30.0 seconds, but got {captured_timeout}"
         )
+
+
+def test_connection_pool_is_shared(monkeypatch) -> None:
+    """Test that all requests of a build share one pooled client, closed after the build."""
+    used_clients = []
+
+    async def mock_post_capturing_client(client, *_args, **_kwargs):
+        used_clients.append(client)
+
+        return MockResponse(status_code=200, content=b"<svg>dummy data</svg>")
+
+    # Arrange
+    with MkDocsHelper("happy_path") as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+
+        monkeypatch.setattr("httpx.AsyncClient.post", mock_post_capturing_client)
+
+        # Act
+        result = mkdocs_helper.invoke_build()
+
+        # Assert
+        assert result.exit_code == 0
+        assert len(used_clients) == 2
+        assert used_clients[0] is used_clients[1]
+        assert used_clients[0].is_closed
@@ -1,6 +1,11 @@
+import struct
+
 import bs4
 import pytest
 
+from kroki.common import ImageSrc
+from kroki.render import _get_image_size
+from tests.conftest import MockResponse
 from tests.utils import MkDocsTemplateHelper
 
 
@@ -256,3 +261,125 @@ A -> B
         assert "display: block" in style
         assert "margin-left: auto" in style
         assert "margin-right: auto" in style
+
+
+# Graphviz sizes its SVGs in points
+GRAPHVIZ_ROOT_TAG = (
+    b'<svg width="62pt" height="116pt" viewBox="0.00 0.00 62.00 116.00" '
+    b'xmlns="http://www.w3.org/2000/svg">'
+)
+SIZED_SVG = b'<?xml version="1.0"?><svg xmlns="http://www.w3.org/2000/svg" width="320px" height="180.4px"><g/></svg>'
+
+
+@pytest.fixture
+def kroki_sized_svg(monkeypatch) -> None:
+    async def mock_post(*_args, **_kwargs):
+        return MockResponse(status_code=200, content=SIZED_SVG)
+
+    monkeypatch.setattr("httpx.AsyncClient.post", mock_post)
+
+
+def _build_img_tag(
+    code_block: str, tag_name: str = "img", theme: None | str = None, **plugin_config
+) -> bs4.Tag:
+    with MkDocsTemplateHelper(code_block) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_tag_format("object" if tag_name == "object" else "img")
+        if theme is not None:
+            mkdocs_helper.config_file["theme"] = {"name": theme}
+        for key, value in plugin_config.items():
+            mkdocs_helper.set_plugin_option(key, value)
+        result = mkdocs_helper.invoke_build()
+
+        assert result.exit_code == 0
+        with open(mkdocs_helper.test_dir / "site/index.html") as f:
+            soup = bs4.BeautifulSoup(f.read(), features="html.parser")
+
+    img_tag = soup.find(
+        tag_name, attrs={"id" if tag_name == "object" else "alt": "Kroki"}
+    )
+    assert img_tag is not None
+    return img_tag
+
+
+@pytest.mark.usefixtures("kroki_sized_svg")
+def test_img_tag_has_intrinsic_size_and_loads_lazily() -> None:
+    img_tag = _build_img_tag("```plantuml\nA -> B\n```")
+
+    assert img_tag["width"] == "320"
+    assert img_tag["height"] == "180"
+    assert img_tag["loading"] == "lazy"
+    assert img_tag["decoding"] == "async"
+
+
+@pytest.mark.usefixtures("kroki_sized_svg")
+@pytest.mark.parametrize("tag_name", ["img", "object"])
+def test_intrinsic_size_keeps_the_aspect_ratio_in_the_mkdocs_theme(
+    tag_name: str,
+) -> None:
+    """Test that images shrunk by the theme (max-width only) are not squashed."""
+    img_tag = _build_img_tag(
+        "```plantuml {display-align=center}\nA -> B\n```", tag_name, theme="mkdocs"
+    )
+
+    assert img_tag["width"] == "320"
+    assert img_tag["height"] == "180"
+    assert img_tag["style"] == (
+        "height: auto; aspect-ratio: 320 / 180; display: block;"
+        " margin-left: auto; margin-right: auto"
+    )
+
+
+@pytest.mark.usefixtures("kroki_sized_svg")
+def test_display_size_replaces_intrinsic_size() -> None:
+    img_tag = _build_img_tag("```plantuml {display-width=500px}\nA -> B\n```")
+
+    assert not img_tag.has_attr("width")
+    assert not img_tag.has_attr("height")
+    assert img_tag["style"] == "width: 500px"
+
+
+@pytest.mark.usefixtures("kroki_sized_svg")
+def test_image_loading_attributes_are_configurable() -> None:
+    img_tag = _build_img_tag(
+        "```plantuml\nA -> B\n```",
+        image_size_attributes=False,
+        image_loading="eager",
+        image_decoding="auto",
+    )
+
+    assert not img_tag.has_attr("width")
+    assert img_tag["loading"] == "eager"
+    assert img_tag["decoding"] == "auto"
+
+
+@pytest.mark.parametrize(
+    ("file_ext", "file_content", "expected_size"),
+    [
+        (
+            "png",
+            b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR" + struct.pack(">II", 640, 480),
+            (640, 480),
+        ),
+        (
+            "jpeg",
+            b"\xff\xd8\xff\xe0\x00\x04\x00\x00"
+            + b"\xff\xc0\x00\x11\x08"
+            + struct.pack(">HH", 300, 400),
+            (400, 300),
+        ),
+        ("svg", b"<svg viewBox='0 0 100 50'/>", (100, 50)),
+        ("svg", GRAPHVIZ_ROOT_TAG, (83, 155)),
+        ("svg", b"<svg width='3in' height='2in' viewBox='0 0 10 20'/>", (288, 192)),
+        ("svg", b"<svg width='1pc' height='10mm'/>", (16, 38)),
+        ("svg", b"<svg width='100%'/>", None),
+        ("png", b"not a png", None),
+        ("pdf", b"%PDF-1.4", None),
+    ],
+)
+def test_image_size_is_read_from_the_header(
+    file_ext: str, file_content: bytes, expected_size: None | tuple[int, int]
+) -> None:
+    image_src = ImageSrc(url="", file_ext=file_ext, file_content=file_content)
+
+    assert _get_image_size(image_src) == expected_size
@@ -0,0 +1,133 @@
+import os
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+from kroki.cache import get_cache_key
+from kroki.client import FILE_PREFIX, DownloadedContent
+from kroki.common import BuildStats
+from tests.utils import MkDocsTemplateHelper, get_img_sources, get_page_context
+
+
+def test_file_name_is_derived_from_content_key():
+    content_key = get_cache_key("graph TD; A-->B;", "mermaid", "png", {})
+
+    downloaded_content = DownloadedContent(b"png data", "png", content_key)
+
+    assert downloaded_content.file_name == f"{FILE_PREFIX}{content_key[:32]}.png"
+
+
+def test_file_name_differs_per_content_key():
+    content_keys = [
+        get_cache_key("graph TD; A-->B;", "mermaid", "png", {"theme": theme})
+        for theme in ("dark", "light")
+    ]
+
+    file_names = {
+        DownloadedContent(b"png data", "png", content_key).file_name
+        for content_key in content_keys
+    }
+
+    assert len(file_names) == 2
+
+
+def test_large_content_is_not_copied():
+    """Benchmark: naming a multi-megabyte diagram must not allocate memory in the order of its size."""
+    file_content = os.urandom(8 * 1024 * 1024)
+    content_key = get_cache_key("graph TD; A-->B;", "mermaid", "pdf", {})
+
+    tracemalloc.start()
+    try:
+        DownloadedContent(file_content, "pdf", content_key)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # the previous naming built the repr of the content (about 4x its size)
+    assert peak_bytes < 64 * 1024
+
+
+CODE_BLOCK = """```mermaid
+graph TD
+    a --> b
+```"""
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_images_are_saved_next_to_pages() -> None:
+    # Arrange
+    with MkDocsTemplateHelper(f"{CODE_BLOCK}\n\n{CODE_BLOCK}") as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        (mkdocs_helper.test_dir / "docs/sub").mkdir()
+        (mkdocs_helper.test_dir / "docs/sub/page.md").write_text(CODE_BLOCK)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        site_dir = mkdocs_helper.test_dir / "site"
+        generated_files = sorted(site_dir.rglob(f"{FILE_PREFIX}*"))
+        assert [file.parent for file in generated_files] == [
+            site_dir,
+            site_dir / "sub" / "page",
+        ]
+        file_name = generated_files[0].name
+        assert get_img_sources(site_dir / "index.html") == [file_name, file_name]
+        assert get_img_sources(site_dir / "sub/page/index.html") == [file_name]
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_images_are_saved_once_in_shared_assets_dir() -> None:
+    # Arrange
+    with MkDocsTemplateHelper(CODE_BLOCK) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_plugin_option("shared_assets_dir", "assets/kroki/")
+        (mkdocs_helper.test_dir / "docs/sub").mkdir()
+        (mkdocs_helper.test_dir / "docs/sub/page.md").write_text(CODE_BLOCK)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        site_dir = mkdocs_helper.test_dir / "site"
+        generated_files = list(site_dir.rglob(f"{FILE_PREFIX}*"))
+        assert len(generated_files) == 1
+        assert generated_files[0].parent == site_dir / "assets" / "kroki"
+        file_name = generated_files[0].name
+        assert get_img_sources(site_dir / "index.html") == [f"assets/kroki/{file_name}"]
+        assert get_img_sources(site_dir / "sub/page/index.html") == [
+            f"../../assets/kroki/{file_name}"
+        ]
+
+
+def test_unchanged_file_is_not_rewritten(tmp_path: Path) -> None:
+    content_key = get_cache_key("graph TD; A-->B;", "mermaid", "svg", {})
+    stats = BuildStats()
+
+    # first build
+    DownloadedContent(b"<svg/>", "svg", content_key).save(
+        get_page_context(tmp_path), stats=stats
+    )
+    (saved_file,) = tmp_path.glob(f"{FILE_PREFIX}*")
+    os.utime(saved_file, (0, 0))
+
+    # rebuild with the same content
+    DownloadedContent(b"<svg/>", "svg", content_key).save(
+        get_page_context(tmp_path), stats=stats
+    )
+
+    assert saved_file.stat().st_mtime == 0
+    assert stats == BuildStats(written_files=1, unchanged_files=1)
+
+
+def test_changed_file_is_replaced(tmp_path: Path) -> None:
+    content_key = get_cache_key("graph TD; A-->B;", "mermaid", "svg", {})
+    stats = BuildStats()
+
+    for file_content in (b"<svg/>", b"<svg>changed</svg>"):
+        DownloadedContent(file_content, "svg", content_key).save(
+            get_page_context(tmp_path), stats=stats
+        )
+
+    (saved_file,) = tmp_path.glob(f"{FILE_PREFIX}*")
+    assert saved_file.read_bytes() == b"<svg>changed</svg>"
+    assert stats == BuildStats(written_files=2, unchanged_files=0)
@@ -1,3 +1,7 @@
+import random
+import re
+import timeit
+from collections.abc import Callable
 from dataclasses import dataclass, field
 from unittest.mock import AsyncMock
 
@@ -6,7 +10,17 @@ from pytest_mock import MockerFixture
 from result import Ok
 
 from kroki.common import KrokiImageContext
-from kroki.parsing import KrokiDiagramTypes, MarkdownParser
+from kroki.parsing import KrokiDiagramTypes, MarkdownParser, iter_fenced_blocks
+
+# the regex used before the fence scanner, as reference for its results
+REFERENCE_FENCE_RE = re.compile(
+    r"(?P<fence>^(?P<indent>[ ]*)(?:````*|~~~~*))[ ]*"
+    r"(\.?(?P<lang>[\w#.+-]*)[ ]*)?"
+    r"(?P<opts>\{[^}]*\}|(?:[ ]?[a-zA-Z0-9\-_]+=[a-zA-Z0-9\-_]+)*)\n"
+    r"(?P<code>.*?)(?<=\n)"
+    r"(?P=fence)[ ]*$",
+    flags=re.IGNORECASE + re.DOTALL + re.MULTILINE,
+)
 
 
 @dataclass
@@ -315,3 +329,185 @@ def test_fences_not_supported(
     parser.replace_kroki_blocks(test_data.page_data, callback_stub, context_stub)
     # Assert
     callback_stub.assert_not_called()
+
+
+def _assert_same_blocks_as_reference(markdown: str) -> None:
+    expected = [
+        (
+            match.span(),
+            match.group("indent"),
+            match.group("lang"),
+            match.group("opts"),
+            match.group("code"),
+        )
+        for match in REFERENCE_FENCE_RE.finditer(markdown)
+    ]
+    actual = [
+        (block.span, block.indent, block.lang, block.opts, block.code)
+        for block in iter_fenced_blocks(markdown)
+    ]
+    assert actual == expected, repr(markdown)
+
+
+@pytest.mark.parametrize(
+    "test_data",
+    [pytest.param(v, id=k) for k, v in TEST_CASES.items()]
+    + [pytest.param(v, id=k) for k, v in TEST_CASES_NOT_COMPLYING.items()]
+    + [pytest.param(v, id=k) for k, v in TEST_CASES_NOT_SUPPORTED.items()],
+)
+def test_fence_scanner_matches_reference(test_data: StubInput) -> None:
+    _assert_same_blocks_as_reference(test_data.page_data)
+
+
+def test_fence_scanner_matches_reference_on_random_pages() -> None:
+    tokens = [
+        "```",
+        "````",
+        "~~~",
+        "`",
+        " ",
+        "\n",
+        "\n",
+        "mermaid",
+        ".c",
+        " a=b",
+        "{",
+        "}",
+        "{a=b}",
+        "\r",
+    ]
+    rnd = random.Random(42)
+    for _ in range(20000):
+        _assert_same_blocks_as_reference(
+            "".join(rnd.choice(tokens) for _ in range(rnd.randint(0, 30)))
+        )
+
+
+def _best_seconds(func: Callable[[], object]) -> float:
+    return min(timeit.repeat(func, number=1, repeat=5))
+
+
+def _page_with_blocks(block_count: int) -> str:
+    code = "x = 1\n" * 20
+    return "".join(
+        f"## Section {index}\n\nSome prose.\n\n```python\n{code}```\n\n"
+        for index in range(block_count)
+    )
+
+
+def _page_with_unclosed_fences(fence_count: int) -> str:
+    # unclosed fences made the previous regex quadratic
+    return "```a\nsome code\n" * fence_count
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("make_page", [_page_with_blocks, _page_with_unclosed_fences])
+def test_fence_scanner_scales_linearly(make_page: Callable[[int], str]) -> None:
+    """Benchmark: scanning a page twice as large takes about twice as long."""
+    page_data = make_page(2500)
+    double_page_data = make_page(5000)
+
+    seconds = _best_seconds(lambda: list(iter_fenced_blocks(page_data)))
+    double_seconds = _best_seconds(lambda: list(iter_fenced_blocks(double_page_data)))
+
+    assert double_seconds < 3 * seconds
+
+
+@pytest.mark.parametrize(
+    "page_data",
+    [
+        "# Title\n\nNo code blocks here.\n",
+        "```python\nprint('mermaid')\n```\n",
+        "Inline ```mermaid``` is no block.\n\n~~~\nmermaid\n~~~\n",
+    ],
+)
+def test_pages_without_kroki_blocks_are_skipped(
+    page_data: str,
+    mock_kroki_diagram_types: KrokiDiagramTypes,
+) -> None:
+    # Arrange
+    parser = MarkdownParser("", mock_kroki_diagram_types)
+    callback_stub = AsyncMock(return_value="")
+    # Act
+    result = parser.replace_kroki_blocks(page_data, callback_stub, None)  # type: ignore[arg-type]
+    # Assert
+    assert result is page_data
+    callback_stub.assert_not_called()
+    assert parser.stats.skipped_pages == (0 if "Inline" in page_data else 1)
+
+
+def test_pre_check_uses_fence_prefix() -> None:
+    diagram_types = KrokiDiagramTypes(
+        "kroki-",
+        ["svg"],
+        {},
+        blockdiag_enabled=True,
+        bpmn_enabled=True,
+        excalidraw_enabled=True,
+        mermaid_enabled=True,
+        diagramsnet_enabled=True,
+    )
+    parser = MarkdownParser("", diagram_types)
+
+    assert not parser._may_contain_kroki_blocks("```mermaid\ngraph TD\n```\n")
+    assert parser._may_contain_kroki_blocks("```kroki-Mermaid\ngraph TD\n```\n")
+
+
+def test_pre_check_finds_all_kroki_blocks_on_random_pages(
+    mock_kroki_diagram_types: KrokiDiagramTypes,
+) -> None:
+    tokens = ["```", "````", "~~~", "`", " ", "\n", "\n", "mermaid", ".", "c", "{a=b}"]
+    parser = MarkdownParser("", mock_kroki_diagram_types)
+    rnd = random.Random(42)
+    for _ in range(20000):
+        page_data = "".join(rnd.choice(tokens) for _ in range(rnd.randint(0, 30)))
+        has_kroki_blocks = any(
+            mock_kroki_diagram_types.get_kroki_type(block.lang) is not None
+            for block in iter_fenced_blocks(page_data)
+        )
+        if has_kroki_blocks:
+            assert parser._may_contain_kroki_blocks(page_data), repr(page_data)
+
+
+def _page_with_kroki_blocks(fence_count: int) -> str:
+    """A page with the given number of fences, half of them kroki blocks."""
+    prose = "Some prose to make the page larger. " * 100 + "\n\n"
+    return "".join(
+        f"{prose}```{'mermaid' if index % 2 else 'python'}\nblock {index}\n```\n\n"
+        for index in range(fence_count)
+    )
+
+
+@pytest.mark.benchmark
+def test_replace_kroki_blocks_scales_linearly(
+    mock_kroki_diagram_types: KrokiDiagramTypes,
+) -> None:
+    """Benchmark: rebuilding a page twice as large takes about twice as long."""
+    parser = MarkdownParser("", mock_kroki_diagram_types)
+    callback_stub = AsyncMock(return_value="<svg/>\n")
+    page_data = _page_with_kroki_blocks(1000)
+    double_page_data = _page_with_kroki_blocks(2000)
+
+    seconds = _best_seconds(
+        lambda: parser.replace_kroki_blocks(page_data, callback_stub, None)  # type: ignore[arg-type]
+    )
+    double_seconds = _best_seconds(
+        lambda: parser.replace_kroki_blocks(double_page_data, callback_stub, None)  # type: ignore[arg-type]
+    )
+
+    assert double_seconds < 3 * seconds
+
+
+def test_replace_many_kroki_blocks(
+    mock_kroki_diagram_types: KrokiDiagramTypes,
+) -> None:
+    page_data = _page_with_kroki_blocks(1000)
+    parser = MarkdownParser("", mock_kroki_diagram_types)
+    callback_stub = AsyncMock(return_value="<svg/>\n")
+
+    result = parser.replace_kroki_blocks(page_data, callback_stub, None)  # type: ignore[arg-type]
+
+    assert callback_stub.call_count == 500
+    assert result.count("<svg/>") == 500
+    assert result.count("```python\n") == 500
+    assert "```mermaid" not in result
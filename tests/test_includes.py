@@ -0,0 +1,115 @@
+import os
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+from kroki.diagram_types import KrokiDiagramTypes
+from kroki.includes import IncludedFiles
+from kroki.parsing import MarkdownParser
+
+
+def _write_keeping_stat(file_path: Path, content: str) -> None:
+    """Change the content without changing modification time and size."""
+    stat = file_path.stat()
+    file_path.write_text(content)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def test_file_is_read_once_while_unchanged(tmp_path: Path) -> None:
+    file_path = tmp_path / "diagram.puml"
+    file_path.write_text("A -> B")
+    included_files = IncludedFiles()
+
+    assert included_files.read(str(file_path)) == "A -> B"
+    _write_keeping_stat(file_path, "B -> A")
+
+    assert included_files.read(str(file_path)) == "A -> B"
+
+
+@pytest.mark.parametrize(
+    ("new_content", "new_mtime_ns"),
+    [
+        pytest.param("B -> A", 10**9, id="mtime changed"),
+        pytest.param("A -> B -> C", 0, id="size changed"),
+    ],
+)
+def test_changed_file_is_read_again(
+    tmp_path: Path, new_content: str, new_mtime_ns: int
+) -> None:
+    file_path = tmp_path / "diagram.puml"
+    file_path.write_text("A -> B")
+    os.utime(file_path, ns=(0, 0))
+    included_files = IncludedFiles()
+    included_files.read(str(file_path))
+
+    file_path.write_text(new_content)
+    os.utime(file_path, ns=(0, new_mtime_ns))
+
+    assert included_files.read(str(file_path)) == new_content
+
+
+def test_missing_file_raises(tmp_path: Path) -> None:
+    with pytest.raises(OSError):
+        IncludedFiles().read(str(tmp_path / "missing.puml"))
+
+
+def test_including_pages_are_tracked() -> None:
+    included_files = IncludedFiles()
+    included_files.set_page_includes("a.md", {"/docs/shared.puml", "/docs/a.puml"})
+    included_files.set_page_includes("b.md", {"/docs/shared.puml"})
+
+    assert included_files.get_including_pages("/docs/shared.puml") == {"a.md", "b.md"}
+    assert included_files.get_including_pages("/docs/a.puml") == {"a.md"}
+
+    # a.md does not include the files anymore
+    included_files.set_page_includes("a.md", set())
+
+    assert included_files.get_including_pages("/docs/shared.puml") == {"b.md"}
+    assert included_files.get_including_pages("/docs/a.puml") == set()
+
+
+def test_parser_collects_included_files(
+    tmp_path: Path, mock_kroki_diagram_types: KrokiDiagramTypes
+) -> None:
+    (tmp_path / "shared.puml").write_text("A -> B")
+    parser = MarkdownParser(str(tmp_path), mock_kroki_diagram_types)
+    context = SimpleNamespace(included_paths=set())
+    callback_stub = AsyncMock(return_value="")
+
+    parser.replace_kroki_blocks(
+        "```plantuml\n@from_file:shared.puml\n```\n\n"
+        "```plantuml\n@from_file:missing.puml\n```\n",
+        callback_stub,
+        context,  # type: ignore[arg-type]
+    )
+
+    assert context.included_paths == {
+        str(tmp_path / "shared.puml"),
+        str(tmp_path / "missing.puml"),
+    }
+    assert callback_stub.call_args_list[0].args[0].data.unwrap() == "A -> B"
+
+
+def test_changed_files_and_dirty_pages(tmp_path: Path) -> None:
+    shared_file, other_file = tmp_path / "shared.puml", tmp_path / "other.puml"
+    for file_path in (shared_file, other_file):
+        file_path.write_text("A -> B")
+    included_files = IncludedFiles()
+    included_files.set_page_includes("a.md", {str(shared_file), str(other_file)})
+    included_files.set_page_includes("b.md", {str(shared_file)})
+    included_files.set_page_includes("c.md", {str(other_file)})
+    for file_path in (shared_file, other_file):
+        included_files.read(str(file_path))
+
+    shared_file.write_text("A -> B -> C")
+    changed_files = included_files.get_changed_files()
+
+    assert changed_files == {str(shared_file)}
+    assert included_files.get_dirty_pages(changed_files) == {"a.md", "b.md"}
+    assert included_files.get_include_graph() == {
+        "a.md": {str(shared_file), str(other_file)},
+        "b.md": {str(shared_file)},
+        "c.md": {str(other_file)},
+    }
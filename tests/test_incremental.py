@@ -0,0 +1,279 @@
+import shutil
+from pathlib import Path
+
+import bs4
+import pytest
+from mkdocs.commands.build import build
+from mkdocs.config import load_config
+from mkdocs.config.defaults import MkDocsConfig
+from pytest_mock import MockerFixture
+
+from kroki.client import FILE_PREFIX, KrokiClient
+from kroki.common import SavedFile
+from tests.compat import chdir
+from tests.utils import MkDocsHelper, MkDocsTemplateHelper, get_img_sources
+
+CODE_BLOCKS = """```mermaid
+graph TD
+    a --> b
+```
+
+```mermaid
+graph TD
+    b --> c
+```"""
+
+
+def _load_config(mkdocs_helper: MkDocsHelper.Context) -> MkDocsConfig:
+    return load_config(str(mkdocs_helper.config_file_path))
+
+
+def _assert_images_are_present(site_dir: Path) -> None:
+    img_sources = get_img_sources(site_dir / "index.html")
+    assert len(img_sources) == 2
+    for img_src in img_sources:
+        assert img_src.startswith(FILE_PREFIX)
+        assert (site_dir / img_src).is_file()
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_unchanged_blocks_are_reused_while_serving(mocker: MockerFixture) -> None:
+    get_image_url_spy = mocker.spy(KrokiClient, "get_image_url")
+
+    # Arrange
+    with MkDocsTemplateHelper(CODE_BLOCKS) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper._dump_config()
+        index_md = mkdocs_helper.test_dir / "docs/index.md"
+        site_dir = mkdocs_helper.test_dir / "site"
+        with chdir(mkdocs_helper.test_dir):
+            config = _load_config(mkdocs_helper)
+            config.plugins.on_startup(command="serve", dirty=False)
+            build(config)
+            assert get_image_url_spy.call_count == 2
+
+            # Act: rebuild after changes, the configuration is loaded again
+            index_md.write_text(index_md.read_text() + "\nMore prose.\n")
+            build(_load_config(mkdocs_helper))
+            reused_call_count = get_image_url_spy.call_count
+
+            index_md.write_text(index_md.read_text().replace("b --> c", "b --> d"))
+            build(_load_config(mkdocs_helper))
+            config.plugins.on_shutdown()
+
+        # Assert
+        assert reused_call_count == 2
+        assert get_image_url_spy.call_count == 3  # only the changed block
+        _assert_images_are_present(site_dir)
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_blocks_are_rendered_again_when_not_cached_anymore(
+    mocker: MockerFixture,
+) -> None:
+    get_image_url_spy = mocker.spy(KrokiClient, "get_image_url")
+
+    # Arrange
+    with MkDocsTemplateHelper(CODE_BLOCKS) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_plugin_option(
+            "cache_dir", str(mkdocs_helper.test_dir / "cache")
+        )
+        mkdocs_helper._dump_config()
+        with chdir(mkdocs_helper.test_dir):
+            config = _load_config(mkdocs_helper)
+            config.plugins.on_startup(command="serve", dirty=False)
+            build(config)
+            rendered_blocks = config.plugins["kroki"].page_records.get_blocks(
+                "index.md"
+            )
+            # Act: the records keep no image data, only the cache has it
+            shutil.rmtree(mkdocs_helper.test_dir / "cache")
+            build(_load_config(mkdocs_helper))
+            config.plugins.on_shutdown()
+
+        # Assert
+        assert all(
+            isinstance(saved_file, SavedFile)
+            for rendered_block in rendered_blocks.values()
+            for saved_file in rendered_block.saved_files
+        )
+        assert get_image_url_spy.call_count == 4
+        _assert_images_are_present(mkdocs_helper.test_dir / "site")
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_inlined_svgs_are_read_from_the_cache_while_serving(
+    mocker: MockerFixture,
+) -> None:
+    get_image_url_spy = mocker.spy(KrokiClient, "get_image_url")
+
+    # Arrange
+    with MkDocsTemplateHelper(CODE_BLOCKS) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_tag_format("svg")
+        mkdocs_helper.set_plugin_option("deduplicate_svgs", True)
+        mkdocs_helper._dump_config()
+        index_md = mkdocs_helper.test_dir / "docs/index.md"
+        with chdir(mkdocs_helper.test_dir):
+            config = _load_config(mkdocs_helper)
+            config.plugins.on_startup(command="serve", dirty=False)
+            build(config)
+            rendered_blocks = config.plugins["kroki"].page_records.get_blocks(
+                "index.md"
+            )
+            # Act
+            index_md.write_text(index_md.read_text() + "\nMore prose.\n")
+            build(_load_config(mkdocs_helper))
+            config.plugins.on_shutdown()
+
+        # Assert: the records keep references only, not the SVG elements
+        assert len(rendered_blocks) == 2
+        for rendered_block in rendered_blocks.values():
+            assert rendered_block.html is None
+            assert rendered_block.cached_html is not None
+        assert get_image_url_spy.call_count == 2
+        soup = bs4.BeautifulSoup(
+            (mkdocs_helper.test_dir / "site/index.html").read_text(),
+            features="html.parser",
+        )
+        svg_tags = soup.find_all("svg", attrs={"class": "kroki"})
+        assert [svg_tag.get_text() for svg_tag in svg_tags] == ["dummy data"] * 2
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_records_of_removed_pages_are_dropped() -> None:
+    # Arrange
+    with MkDocsTemplateHelper(CODE_BLOCKS) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper._dump_config()
+        other_md = mkdocs_helper.test_dir / "docs/sub/other.md"
+        other_md.parent.mkdir()
+        other_md.write_text(CODE_BLOCKS)
+        with chdir(mkdocs_helper.test_dir):
+            config = _load_config(mkdocs_helper)
+            config.plugins.on_startup(command="serve", dirty=False)
+            build(config)
+            page_records = config.plugins["kroki"].page_records
+            assert len(page_records.get_blocks("sub/other.md")) == 2
+
+            # Act
+            other_md.unlink()
+            build(_load_config(mkdocs_helper))
+            config.plugins.on_shutdown()
+
+        # Assert
+        assert page_records.get_blocks("sub/other.md") == {}
+        assert len(page_records.get_blocks("index.md")) == 2
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_config_change_renders_all_blocks_again(mocker: MockerFixture) -> None:
+    get_image_url_spy = mocker.spy(KrokiClient, "get_image_url")
+
+    # Arrange
+    with MkDocsTemplateHelper(CODE_BLOCKS) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper._dump_config()
+        with chdir(mkdocs_helper.test_dir):
+            config = _load_config(mkdocs_helper)
+            config.plugins.on_startup(command="serve", dirty=False)
+            build(config)
+
+            # Act
+            mkdocs_helper.set_tag_format("object")
+            mkdocs_helper._dump_config()
+            build(_load_config(mkdocs_helper))
+            config.plugins.on_shutdown()
+
+        # Assert
+        assert get_image_url_spy.call_count == 4
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_blocks_are_not_reused_between_builds(mocker: MockerFixture) -> None:
+    get_image_url_spy = mocker.spy(KrokiClient, "get_image_url")
+
+    # Arrange
+    with MkDocsTemplateHelper(CODE_BLOCKS) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        # Act
+        for _ in range(2):
+            result = mkdocs_helper.invoke_build()
+            assert result.exit_code == 0
+        # Assert
+        assert get_image_url_spy.call_count == 4
+        _assert_images_are_present(mkdocs_helper.test_dir / "site")
+
+
+INCLUDE_BLOCK = """```mermaid
+@from_file:../diagrams/diagram.mmd
+```"""
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_included_files_outside_docs_dir_are_watched(mocker: MockerFixture) -> None:
+    # Arrange
+    with MkDocsTemplateHelper(INCLUDE_BLOCK) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper._dump_config()
+        diagram_file = mkdocs_helper.test_dir / "diagrams/diagram.mmd"
+        diagram_file.parent.mkdir()
+        diagram_file.write_text("graph TD\n    a --> b\n")
+        server = mocker.Mock()
+        with chdir(mkdocs_helper.test_dir):
+            config = _load_config(mkdocs_helper)
+            config.plugins.on_startup(command="serve", dirty=False)
+            build(config)
+            # Act
+            config.plugins.on_serve(server, config=config, builder=mocker.stub())
+            config.plugins.on_shutdown()
+
+        # Assert
+        server.watch.assert_called_once_with(str(diagram_file), recursive=False)
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_dirty_build_rebuilds_pages_including_changed_files() -> None:
+    # Arrange
+    with MkDocsTemplateHelper(INCLUDE_BLOCK) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper._dump_config()
+        diagram_file = mkdocs_helper.test_dir / "diagrams/diagram.mmd"
+        diagram_file.parent.mkdir()
+        diagram_file.write_text("graph TD\n    a --> b\n")
+        site_dir = mkdocs_helper.test_dir / "site"
+        with chdir(mkdocs_helper.test_dir):
+            config = _load_config(mkdocs_helper)
+            config.plugins.on_startup(command="serve", dirty=True)
+            build(config, dirty=True)
+            img_sources = get_img_sources(site_dir / "index.html")
+
+            # Act
+            diagram_file.write_text("graph TD\n    a --> c\n")
+            build(_load_config(mkdocs_helper), dirty=True)
+            config.plugins.on_shutdown()
+
+        # Assert
+        changed_img_sources = get_img_sources(site_dir / "index.html")
+        assert len(changed_img_sources) == 1
+        assert changed_img_sources != img_sources
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_build_without_startup_event(monkeypatch) -> None:
+    # MkDocs keeps plugin instances with startup events between configs
+    monkeypatch.setattr(MkDocsConfig.plugins, "plugin_cache", {})
+    # Arrange
+    with MkDocsTemplateHelper(INCLUDE_BLOCK) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper._dump_config()
+        diagram_file = mkdocs_helper.test_dir / "diagrams/diagram.mmd"
+        diagram_file.parent.mkdir()
+        diagram_file.write_text("graph TD\n    a --> b\n")
+        with chdir(mkdocs_helper.test_dir):
+            # Act: builds started from Python may skip on_startup
+            build(_load_config(mkdocs_helper))
+
+        # Assert
+        assert len(get_img_sources(mkdocs_helper.test_dir / "site/index.html")) == 1
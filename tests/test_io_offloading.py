@@ -0,0 +1,174 @@
+import asyncio
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from result import Ok
+
+from kroki.cache import KrokiCache
+from kroki.client import KrokiClient
+from kroki.common import (
+    BuildStats,
+    KrokiImageContext,
+    SavedFile,
+)
+from kroki.incremental import RenderedBlock
+from tests.conftest import MockResponse
+from tests.utils import get_page_context
+
+DISK_LATENCY_SECONDS = 0.05
+DIAGRAM_COUNT = 20
+
+
+class _SlowDisk:
+    """Let file reads and replacements take a while and track the peak number of parallel calls."""
+
+    def __init__(self) -> None:
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def wrap(self, func):
+        def slow_func(*args, **kwargs):
+            with self._lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            try:
+                time.sleep(DISK_LATENCY_SECONDS)
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+
+        return slow_func
+
+
+@pytest.fixture
+def slow_disk(monkeypatch) -> _SlowDisk:
+    slow_disk = _SlowDisk()
+    slow_replace = slow_disk.wrap(os.replace)
+    monkeypatch.setattr("os.replace", slow_replace)
+    monkeypatch.setattr("kroki.client.replace", slow_replace)
+    monkeypatch.setattr("pathlib.Path.read_bytes", slow_disk.wrap(Path.read_bytes))
+    return slow_disk
+
+
+@pytest.fixture
+def requested_urls(monkeypatch) -> list[str]:
+    urls = []
+
+    async def mock_post(_client, url, **_kwargs):
+        urls.append(url)
+        await asyncio.sleep(0.01)
+        return MockResponse(status_code=200, content=b"<svg>dummy data</svg>")
+
+    monkeypatch.setattr("httpx.AsyncClient.post", mock_post)
+    return urls
+
+
+def _create_client(cache_dir: Path, diagram_types, stats: BuildStats) -> KrokiClient:
+    return KrokiClient(
+        server_url="https://kroki.io",
+        http_method="POST",
+        user_agent="test",
+        timeout_seconds=30,
+        diagram_types=diagram_types,
+        cache=KrokiCache(cache_dir=str(cache_dir)),
+        stats=stats,
+    )
+
+
+def _render_all(
+    cache_dir: Path, site_dir: Path, diagram_types, stats: BuildStats
+) -> list[SavedFile]:
+    async def _render() -> list[SavedFile]:
+        client = _create_client(cache_dir, diagram_types, stats)
+        context = get_page_context(site_dir)
+        try:
+            results = await asyncio.gather(
+                *(
+                    client.get_image_url(
+                        KrokiImageContext(
+                            kroki_type="mermaid",
+                            options={},
+                            plugin_options={},
+                            data=Ok(f"graph TD; A-->B{index};"),
+                        ),
+                        context,
+                    )
+                    for index in range(DIAGRAM_COUNT)
+                )
+            )
+        finally:
+            await client.aclose()
+        assert all(result.is_ok() for result in results)
+        return context.saved_files
+
+    return asyncio.run(_render())
+
+
+def test_writes_on_a_slow_disk_do_not_block_the_build(
+    tmp_path: Path, slow_disk, requested_urls, mock_kroki_diagram_types
+) -> None:
+    """Test that the cache file and the site file of the diagrams are written in parallel."""
+    stats = BuildStats()
+
+    _render_all(tmp_path / "cache", tmp_path / "site", mock_kroki_diagram_types, stats)
+
+    assert len(requested_urls) == DIAGRAM_COUNT
+    assert stats.written_files == DIAGRAM_COUNT
+    assert slow_disk.peak > 1
+
+
+def test_reads_on_a_slow_disk_do_not_block_the_build(
+    tmp_path: Path, slow_disk, requested_urls, mock_kroki_diagram_types
+) -> None:
+    """Test that the diagrams are read from the file cache of a previous build in parallel."""
+    _render_all(
+        tmp_path / "cache", tmp_path / "site", mock_kroki_diagram_types, BuildStats()
+    )
+    requested_urls.clear()
+    slow_disk.peak = 0
+    stats = BuildStats()
+
+    _render_all(tmp_path / "cache", tmp_path / "site", mock_kroki_diagram_types, stats)
+
+    assert requested_urls == []
+    assert stats.unchanged_files == DIAGRAM_COUNT
+    assert slow_disk.peak > 1
+
+
+def test_restored_blocks_do_not_block_the_build(
+    tmp_path: Path, slow_disk, requested_urls, mock_kroki_diagram_types
+) -> None:
+    """Test that the files of blocks reused while serving are read and written in parallel."""
+    saved_files = _render_all(
+        tmp_path / "cache", tmp_path / "site", mock_kroki_diagram_types, BuildStats()
+    )
+    requested_urls.clear()
+    slow_disk.peak = 0
+    stats = BuildStats()
+
+    async def _restore_all() -> list[None | str]:
+        client = _create_client(tmp_path / "cache", mock_kroki_diagram_types, stats)
+        context = get_page_context(tmp_path / "rebuilt_site")
+        try:
+            return await asyncio.gather(
+                *(
+                    RenderedBlock(html="<img/>", saved_files=[saved_file]).restore(
+                        context, client
+                    )
+                    for saved_file in saved_files
+                )
+            )
+        finally:
+            await client.aclose()
+
+    restored_html = asyncio.run(_restore_all())
+
+    assert restored_html == ["<img/>"] * DIAGRAM_COUNT
+    assert requested_urls == []
+    assert stats.written_files == DIAGRAM_COUNT
+    assert slow_disk.peak > 1
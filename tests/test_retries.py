@@ -0,0 +1,125 @@
+import bs4
+import httpx
+import pytest
+
+from kroki.client import _parse_retry_after
+from tests.conftest import MockResponse
+from tests.utils import MkDocsHelper
+
+
+def _mock_post_responses(monkeypatch, responses: list) -> list[str]:
+    """Let request post calls return (or raise) the given responses in order."""
+    requested_urls = []
+
+    async def mock_post(_client, url, **_kwargs):
+        requested_urls.append(url)
+        response = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr("httpx.AsyncClient.post", mock_post)
+    return requested_urls
+
+
+def _enable_retries(mkdocs_helper: MkDocsHelper.Context, **options) -> None:
+    mkdocs_helper.set_plugin_option("max_retries", 2)
+    mkdocs_helper.set_plugin_option("retry_backoff_seconds", 0)
+    for key, value in options.items():
+        mkdocs_helper.set_plugin_option(key, value)
+
+
+def _count_images(mkdocs_helper: MkDocsHelper.Context) -> int:
+    with open(mkdocs_helper.test_dir / "site/index.html") as index_html_file:
+        index_soup = bs4.BeautifulSoup(index_html_file.read())
+    return len(index_soup.find_all("img", attrs={"alt": "Kroki"}))
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        httpx.ConnectTimeout("Connection timeout"),
+        httpx.RemoteProtocolError("Server disconnected without sending a response."),
+    ],
+)
+def test_retry_on_transport_error(monkeypatch, error) -> None:
+    requested_urls = _mock_post_responses(
+        monkeypatch,
+        [
+            error,
+            error,
+            MockResponse(status_code=200, content=b"<svg>dummy data</svg>"),
+        ],
+    )
+    # Arrange
+    with MkDocsHelper("happy_path") as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        _enable_retries(mkdocs_helper)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert len(requested_urls) == 4
+        assert _count_images(mkdocs_helper) == 2
+
+
+def test_retry_on_service_unavailable(monkeypatch) -> None:
+    requested_urls = _mock_post_responses(
+        monkeypatch,
+        [
+            MockResponse(status_code=503, headers={"Retry-After": "0"}),
+            MockResponse(status_code=429, headers={"Retry-After": "0"}),
+            MockResponse(status_code=200, content=b"<svg>dummy data</svg>"),
+        ],
+    )
+    # Arrange
+    with MkDocsHelper("happy_path") as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        _enable_retries(mkdocs_helper)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert len(requested_urls) == 4
+        assert _count_images(mkdocs_helper) == 2
+
+
+@pytest.mark.usefixtures("kroki_bad_request")
+def test_no_retry_on_diagram_error() -> None:
+    # Arrange
+    with MkDocsHelper("happy_path") as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        _enable_retries(mkdocs_helper)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert "Retrying request" not in result.output
+
+
+def test_retry_budget(monkeypatch) -> None:
+    requested_urls = _mock_post_responses(
+        monkeypatch, [httpx.ConnectTimeout("Connection timeout")]
+    )
+    # Arrange
+    with MkDocsHelper("happy_path") as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        _enable_retries(mkdocs_helper, retry_budget=1)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert len(requested_urls) == 3
+
+
+@pytest.mark.parametrize(
+    ("retry_after", "expected_delay"),
+    [
+        (None, None),
+        ("3", 3.0),
+        ("not a date", None),
+        ("Wed, 21 Oct 2015 07:28:00 GMT", 0.0),
+    ],
+)
+def test_parse_retry_after(retry_after, expected_delay) -> None:
+    assert _parse_retry_after(retry_after) == expected_delay
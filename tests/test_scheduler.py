@@ -0,0 +1,113 @@
+import asyncio
+
+import bs4
+import pytest
+
+from kroki.cache import KrokiCache
+from kroki.client import KrokiClient
+from kroki.scheduler import BuildScheduler
+from tests.conftest import MockResponse
+from tests.utils import MkDocsHelper
+
+
+@pytest.mark.parametrize("prefetch_diagrams", [True, False])
+def test_prefetch_requests_each_diagram_once(monkeypatch, prefetch_diagrams) -> None:
+    """Test that prefetched diagrams are served from the cache during page handling."""
+    requested_urls = []
+
+    async def mock_post(_client, url, **_kwargs):
+        requested_urls.append(url)
+        return MockResponse(status_code=200, content=b"<svg>dummy data</svg>")
+
+    monkeypatch.setattr("httpx.AsyncClient.post", mock_post)
+
+    # Arrange
+    with MkDocsHelper("happy_path") as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_plugin_option("prefetch_diagrams", prefetch_diagrams)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        assert sorted(requested_urls) == [
+            "https://kroki.io/c4plantuml/svg",
+            "https://kroki.io/plantuml/svg",
+        ]
+        with open(mkdocs_helper.test_dir / "site/index.html") as index_html_file:
+            index_soup = bs4.BeautifulSoup(index_html_file.read())
+
+        assert len(index_soup.find_all("img", attrs={"alt": "Kroki"})) == 2
+
+
+@pytest.mark.usefixtures("kroki_timeout")
+def test_prefetch_errors_are_reported_on_page() -> None:
+    # Arrange
+    with MkDocsHelper("happy_path") as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_plugin_option("prefetch_diagrams", True)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        with open(mkdocs_helper.test_dir / "site/index.html") as index_html_file:
+            index_soup = bs4.BeautifulSoup(index_html_file.read())
+
+        assert len(index_soup.find_all("details")) == 2
+
+
+def test_prefetch_failures_are_not_requested_again(monkeypatch) -> None:
+    """Test that diagrams failing during prefetch don't use up the retries again on their page."""
+    requested_urls = []
+
+    async def mock_post(_client, url, **_kwargs):
+        requested_urls.append(url)
+        return MockResponse(status_code=503)
+
+    monkeypatch.setattr("httpx.AsyncClient.post", mock_post)
+
+    # Arrange
+    with MkDocsHelper("happy_path") as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_plugin_option("prefetch_diagrams", True)
+        mkdocs_helper.set_plugin_option("max_retries", 2)
+        mkdocs_helper.set_plugin_option("retry_backoff_seconds", 0)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 0
+        # two diagrams, with two retries each
+        assert len(requested_urls) == 6
+        with open(mkdocs_helper.test_dir / "site/index.html") as index_html_file:
+            index_soup = bs4.BeautifulSoup(index_html_file.read())
+
+        assert len(index_soup.find_all("details")) == 2
+
+
+def test_close_cancels_pending_tasks(tmp_path, mock_kroki_diagram_types) -> None:
+    """Test that tasks left behind (e.g. by a fail-fast error) are not left on the closed loop."""
+    kroki_client = KrokiClient(
+        server_url="https://kroki.io",
+        http_method="POST",
+        user_agent="test",
+        timeout_seconds=30,
+        diagram_types=mock_kroki_diagram_types,
+        cache=KrokiCache(cache_dir=str(tmp_path)),
+    )
+    scheduler = BuildScheduler(kroki_client)
+    cancelled = []
+
+    async def pending_rendering() -> None:
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    pending_task = scheduler.event_loop.create_task(pending_rendering())
+    scheduler.event_loop.run_until_complete(asyncio.sleep(0))
+
+    scheduler.close()
+
+    assert pending_task.cancelled()
+    assert cancelled == [True]
+    assert scheduler.event_loop.is_closed()
@@ -0,0 +1,360 @@
+import time
+from pathlib import Path
+from xml.etree import ElementTree as XmlElementTree
+
+import bs4
+import pytest
+from defusedxml import EntitiesForbidden
+
+from kroki.common import ImageSrc
+from kroki.render import ContentRenderer
+from kroki.svg import (
+    deduplicate_svgs,
+    optimize_svg,
+    set_root_attributes,
+    set_svg_key,
+)
+from tests.conftest import MockResponse
+from tests.utils import MkDocsTemplateHelper, get_expected_log_line
+
+SVG_NAMESPACE = "{http://www.w3.org/2000/svg}"
+KROKI_ATTRIBUTES = {"preserveAspectRatio": "xMaxYMax meet", "id": "Kroki"}
+
+
+def _large_svg(path_count: int) -> str:
+    paths = "".join(
+        f'<g class="node"><path d="M{index} 0 L{index} 100 Z" fill="#fff"/>'
+        f"<text x='{index}' y=\"50\">node &amp; {index}</text></g>"
+        for index in range(path_count)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="no"?>'
+        '<svg xmlns="http://www.w3.org/2000/svg" '
+        'xmlns:xlink="http://www.w3.org/1999/xlink" width="800" height="600">'
+        f"{paths}</svg>"
+    )
+
+
+def test_root_attributes_are_set_and_replaced() -> None:
+    svg_data = '<svg xmlns="http://www.w3.org/2000/svg" id="old" width="10"><g/></svg>'
+
+    svg_element = set_root_attributes(svg_data, KROKI_ATTRIBUTES)
+
+    assert svg_element == (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="10"'
+        ' preserveAspectRatio="xMaxYMax meet" id="Kroki"><g/></svg>'
+    )
+
+
+def test_prolog_is_dropped() -> None:
+    svg_data = (
+        '\ufeff<?xml version="1.0"?>\n<!-- generated -->\n'
+        '<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" '
+        '"http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n'
+        "<svg viewBox='0 0 1 1'><!-- kept --></svg>"
+    )
+
+    svg_element = set_root_attributes(svg_data, {"id": "Kroki"})
+
+    assert svg_element == "<svg viewBox='0 0 1 1' id=\"Kroki\"><!-- kept --></svg>"
+
+
+def test_attribute_values_are_escaped() -> None:
+    svg_element = set_root_attributes("<svg/>", {"style": 'width: 1px" onload="x'})
+
+    assert svg_element == '<svg style="width: 1px&quot; onload=&quot;x"/>'
+
+
+@pytest.mark.parametrize(
+    "svg_data",
+    [
+        '<!DOCTYPE svg [<!ENTITY a "aaaa">]><svg>&a;</svg>',
+        '<svg:svg xmlns:svg="http://www.w3.org/2000/svg"/>',
+        "<svg width=10></svg>",
+        "<html><svg/></html>",
+    ],
+)
+def test_documents_needing_a_parser_are_not_rewritten(svg_data: str) -> None:
+    assert set_root_attributes(svg_data, KROKI_ATTRIBUTES) is None
+
+
+def test_entity_declarations_are_rejected() -> None:
+    """Test that a billion laughs SVG is not expanded."""
+    entities = "".join(
+        '<!ENTITY lol{} "{}">'.format(index, f"&lol{index - 1};" * 10)
+        for index in range(1, 10)
+    )
+    svg_data = f'<!DOCTYPE svg [<!ENTITY lol0 "lol">{entities}]><svg>&lol9;</svg>'
+    image_src = ImageSrc(url="", file_ext="svg", file_content=svg_data.encode())
+
+    with pytest.raises(EntitiesForbidden):
+        ContentRenderer._svg_data(image_src, {})
+
+
+def test_rewritten_svg_matches_parsed_svg() -> None:
+    svg_data = _large_svg(10)
+    plugin_options = {"display-width": "500px"}
+    image_src = ImageSrc(url="", file_ext="svg", file_content=svg_data.encode())
+    svg_attributes = ContentRenderer._svg_root_attributes(plugin_options)
+
+    rewritten_svg = XmlElementTree.fromstring(
+        ContentRenderer._svg_data(image_src, plugin_options)
+    )
+    parsed_svg = XmlElementTree.fromstring(
+        ContentRenderer._parsed_svg_data(svg_data, svg_attributes)
+    )
+
+    assert rewritten_svg.attrib == parsed_svg.attrib
+    assert [element.tag for element in rewritten_svg.iter()] == [
+        element.tag for element in parsed_svg.iter()
+    ]
+    assert rewritten_svg.attrib["style"] == "width: 500px"
+    assert rewritten_svg.tag == f"{SVG_NAMESPACE}svg"
+
+
+@pytest.mark.benchmark
+def test_root_tag_rewriting_benchmark() -> None:
+    """Benchmark: rewrite a multi-megabyte SVG compared to parsing and serializing it."""
+    svg_data = _large_svg(30_000)
+    assert len(svg_data) > 3 * 1024 * 1024
+    svg_attributes = ContentRenderer._svg_root_attributes({"display-width": "80%"})
+
+    start_time = time.perf_counter()
+    ContentRenderer._parsed_svg_data(svg_data, svg_attributes)
+    parsed_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    set_root_attributes(svg_data, svg_attributes)
+    rewritten_seconds = time.perf_counter() - start_time
+
+    assert rewritten_seconds * 20 < parsed_seconds
+
+
+def _get_inline_svgs(html_file: Path) -> list[bs4.Tag]:
+    soup = bs4.BeautifulSoup(html_file.read_text(), features="html.parser")
+    return soup.find_all("svg", attrs={"id": "Kroki"})
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_inlined_svg_is_cached(mocker) -> None:
+    code_block = """```plantuml {display-width=500px}
+A -> B
+```
+
+```plantuml {display-width=500px}
+A -> B
+```
+
+```plantuml {display-width=600px}
+A -> B
+```"""
+    with MkDocsTemplateHelper(code_block) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_tag_format("svg")
+        mkdocs_helper.set_plugin_option(
+            "cache_dir", str(mkdocs_helper.test_dir / "cache")
+        )
+        svg_data_spy = mocker.spy(ContentRenderer, "_svg_data")
+
+        first_result = mkdocs_helper.invoke_build()
+        first_svgs = _get_inline_svgs(mkdocs_helper.test_dir / "site/index.html")
+        # one for each display width
+        assert svg_data_spy.call_count == 2
+
+        second_result = mkdocs_helper.invoke_build()
+        second_svgs = _get_inline_svgs(mkdocs_helper.test_dir / "site/index.html")
+
+        assert first_result.exit_code == second_result.exit_code == 0
+        assert svg_data_spy.call_count == 2
+        assert second_svgs == first_svgs
+        assert [svg_tag["style"] for svg_tag in first_svgs] == [
+            "width: 500px",
+            "width: 500px",
+            "width: 600px",
+        ]
+
+
+PLANTUML_SVG = b"""<?xml version="1.0" encoding="us-ascii" standalone="no"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="113.1667px" viewBox="0 0 113.1667 134.6042">
+  <!--MD5=[3b8b0ad5bd5ec28a0ae5ebb7f4ab2d51]-->
+  <metadata><rdf:RDF><cc:Work/></rdf:RDF></metadata>
+  <g>
+    <rect fill="#FEFECE" height="30.2969" width="43.1245" x="8.0004" y="8.5"/>
+    <path d="M29.56,38.7969 L29.56,95.5938 M1.23456.5"/>
+    <text x="15.0003" y="28.1953">Alice  and <tspan dx="1.0001">Bob</tspan> <tspan>x="1.2345"</tspan></text>
+  </g>
+</svg>
+"""
+
+
+def test_safe_optimization() -> None:
+    assert optimize_svg(PLANTUML_SVG, "safe").decode() == (
+        '<?xml version="1.0" encoding="us-ascii" standalone="no"?>\n'
+        '<svg xmlns="http://www.w3.org/2000/svg" width="113.167px" viewBox="0 0 113.167 134.604">\n'
+        "<g>\n"
+        '<rect fill="#FEFECE" height="30.297" width="43.124" x="8" y="8.5"/>\n'
+        '<path d="M29.56,38.797 L29.56,95.594 M1.23456.5"/>\n'
+        '<text x="15" y="28.195">Alice  and <tspan dx="1">Bob</tspan> <tspan>x="1.2345"</tspan></text>\n'
+        "</g>\n"
+        "</svg>\n"
+    )
+
+
+def test_aggressive_optimization() -> None:
+    assert optimize_svg(PLANTUML_SVG, "aggressive").decode() == (
+        '<?xml version="1.0" encoding="us-ascii" standalone="no"?>'
+        '<svg xmlns="http://www.w3.org/2000/svg" width="113.17px" viewBox="0 0 113.17 134.6">'
+        "<g>"
+        '<rect fill="#FEFECE" height="30.3" width="43.12" x="8" y="8.5"/>'
+        '<path d="M29.56,38.8 L29.56,95.59 M1.23456.5"/>'
+        '<text x="15" y="28.2">Alice  and <tspan dx="1">Bob</tspan> <tspan>x="1.2345"</tspan></text>'
+        "</g>"
+        "</svg>\n"
+    )
+
+
+@pytest.mark.parametrize("level", ["safe", "aggressive"])
+def test_optimization_keeps_transforms(level: str) -> None:
+    svg_data = (
+        b'<svg><g transform="scale(0.0004)"><rect width="2500.5" height="10"/></g>'
+        b'<g transform="matrix(0.70711 0.70711 -0.70711 0.70711 1000.12345 0)"/></svg>'
+    )
+
+    assert optimize_svg(svg_data, level) == svg_data
+
+
+def test_optimization_keeps_cdata() -> None:
+    svg_data = b"<svg><style><![CDATA[ <!-- .a { x: 1.23456 } --> ]]></style></svg>"
+
+    assert optimize_svg(svg_data, "aggressive") == svg_data
+
+
+def test_optimized_svg_is_cached_and_reported(monkeypatch) -> None:
+    async def mock_post(*_args, **_kwargs):
+        return MockResponse(status_code=200, content=PLANTUML_SVG)
+
+    monkeypatch.setattr("httpx.AsyncClient.post", mock_post)
+    code_block = """```plantuml
+A -> B
+```"""
+    with MkDocsTemplateHelper(code_block) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_plugin_option("svg_optimization", "safe")
+        mkdocs_helper.set_plugin_option(
+            "cache_dir", str(mkdocs_helper.test_dir / "cache")
+        )
+
+        first_result = mkdocs_helper.invoke_build()
+        second_result = mkdocs_helper.invoke_build()
+
+        assert first_result.exit_code == second_result.exit_code == 0
+        (svg_file,) = (mkdocs_helper.test_dir / "site").glob("*.svg")
+        assert svg_file.read_bytes() == optimize_svg(PLANTUML_SVG, "safe")
+        bytes_saved = len(PLANTUML_SVG) - svg_file.stat().st_size
+        assert (
+            get_expected_log_line(f"SVGs: 1 optimized, {bytes_saved} bytes saved")
+            in first_result.output
+        )
+        # the second build uses the optimized diagram of the cache
+        assert (
+            get_expected_log_line("SVGs: 0 optimized, 0 bytes saved")
+            in second_result.output
+        )
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_svg_optimization_must_be_a_level() -> None:
+    with MkDocsTemplateHelper("") as mkdocs_helper:
+        mkdocs_helper.set_plugin_option("svg_optimization", "max")
+        result = mkdocs_helper.invoke_build()
+
+        assert result.exit_code == 1
+
+
+def test_repeated_svgs_use_one_symbol() -> None:
+    svg_element = (
+        '<svg viewBox="0 0 10 10" id="Kroki"><defs><marker id="arrow"/></defs>'
+        '<path marker-end="url(#arrow)"/></svg>'
+    )
+    html = "\n\n".join(
+        [
+            set_svg_key(svg_element, "aaaa"),
+            set_svg_key(svg_element.replace(">", ' style="width: 5px">', 1), "aaaa"),
+            set_svg_key(
+                '<svg id="Kroki" class=\'a "b"\'><g id="arrow"/></svg>', "bbbb"
+            ),
+        ]
+    )
+
+    assert deduplicate_svgs(html).split("\n\n") == [
+        (
+            '<svg viewBox="0 0 10 10" id="Kroki-aaaa-1" class="kroki">'
+            '<symbol id="kroki-aaaa" viewBox="0 0 10 10">'
+            '<defs><marker id="kroki-aaaa-arrow"/></defs>'
+            '<path marker-end="url(#kroki-aaaa-arrow)"/></symbol>'
+            '<use href="#kroki-aaaa"/></svg>'
+        ),
+        (
+            '<svg viewBox="0 0 10 10" id="Kroki-aaaa-2" style="width: 5px"'
+            ' class="kroki"><use href="#kroki-aaaa"/></svg>'
+        ),
+        (
+            '<svg id="Kroki-bbbb-1" class="a &quot;b&quot; kroki">'
+            '<g id="kroki-bbbb-arrow"/></svg>'
+        ),
+    ]
+
+
+def test_nested_svgs_are_deduplicated_as_a_whole() -> None:
+    svg_element = '<svg viewBox="0 0 2 2"><svg x="1"><g/></svg></svg>'
+    html = f"{set_svg_key(svg_element, 'aaaa')}\n{set_svg_key(svg_element, 'aaaa')}"
+
+    assert deduplicate_svgs(html) == (
+        '<svg viewBox="0 0 2 2" class="kroki">'
+        '<symbol id="kroki-aaaa" viewBox="0 0 2 2">'
+        '<svg x="1"><g/></svg></symbol><use href="#kroki-aaaa"/></svg>\n'
+        '<svg viewBox="0 0 2 2" class="kroki"><use href="#kroki-aaaa"/></svg>'
+    )
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_repeated_diagrams_are_deduplicated_on_a_page() -> None:
+    code_block = """```plantuml
+A -> B
+```
+
+```plantuml {display-width=500px}
+A -> B
+```
+
+```mermaid
+graph TD; A-->B;
+```"""
+    with MkDocsTemplateHelper(code_block) as mkdocs_helper:
+        mkdocs_helper.set_http_method("POST")
+        mkdocs_helper.set_tag_format("svg")
+        mkdocs_helper.set_plugin_option("deduplicate_svgs", True)
+
+        result = mkdocs_helper.invoke_build()
+
+        assert result.exit_code == 0
+        soup = bs4.BeautifulSoup(
+            (mkdocs_helper.test_dir / "site/index.html").read_text(),
+            features="html.parser",
+        )
+        svg_tags = soup.find_all("svg", attrs={"class": "kroki"})
+        assert len(svg_tags) == 3
+        svg_ids = [svg_tag["id"] for svg_tag in svg_tags]
+        assert len(set(svg_ids)) == 3
+        assert all(svg_id.startswith("Kroki-") for svg_id in svg_ids)
+        assert soup.find_all(attrs={"id": "Kroki"}) == []
+        assert len(svg_tags[0].find_all("symbol")) == 1
+        symbol_id = svg_tags[0].symbol["id"]
+        assert [svg_tag.use["href"] for svg_tag in svg_tags[:2]] == [
+            f"#{symbol_id}",
+            f"#{symbol_id}",
+        ]
+        assert svg_tags[1].find("symbol") is None
+        assert svg_tags[1]["style"] == "width: 500px"
+        assert svg_tags[2].find("use") is None
+        assert all(not svg_tag.has_attr("data-kroki-svg") for svg_tag in svg_tags)
@@ -0,0 +1,111 @@
+import asyncio
+import base64
+import tempfile
+import zlib
+from urllib.parse import urlsplit
+
+import pytest
+from result import Ok
+
+from kroki.cache import KrokiCache
+from kroki.client import KrokiClient
+from kroki.common import BuildStats, KrokiImageContext
+from kroki.diagram_types import KrokiDiagramTypes
+from tests.utils import MkDocsTemplateHelper
+
+DIAGRAM_SOURCE = "@startuml\nAlice -> Bob: Hello\n@enduml\n" * 20
+
+
+def _get_client(
+    cache: KrokiCache,
+    diagram_types: KrokiDiagramTypes,
+    compression_level: int = 9,
+) -> KrokiClient:
+    return KrokiClient(
+        server_url="https://kroki.io",
+        http_method="GET",
+        user_agent="test",
+        timeout_seconds=30,
+        diagram_types=diagram_types,
+        cache=cache,
+        compression_level=compression_level,
+        stats=BuildStats(),
+    )
+
+
+def _get_url(client: KrokiClient, options: dict) -> str:
+    kroki_context = KrokiImageContext(
+        kroki_type="plantuml",
+        options=options,
+        plugin_options={},
+        data=Ok(DIAGRAM_SOURCE),
+    )
+
+    async def _get_image_url() -> str:
+        return (await client._kroki_url_get(kroki_context)).unwrap().url
+
+    return asyncio.run(_get_image_url())
+
+
+def _decode_url(url: str) -> str:
+    data_param = urlsplit(url).path.split("/")[-1]
+    return zlib.decompress(base64.urlsafe_b64decode(data_param)).decode()
+
+
+def test_encoded_source_is_cached(mock_kroki_diagram_types) -> None:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        client = _get_client(KrokiCache(cache_dir), mock_kroki_diagram_types)
+        url = _get_url(client, {})
+        # the options are not part of the encoded source
+        url_with_options = _get_url(client, {"theme": "dark"})
+
+        # a later build reads the encoded source from the file cache
+        cache = KrokiCache(cache_dir)
+        next_client = _get_client(cache, mock_kroki_diagram_types)
+        next_url = _get_url(next_client, {})
+
+    assert client.stats.encoded_sources == 1
+    assert url_with_options == f"{url}theme=dark"
+    assert next_url == url
+    assert next_client.stats.encoded_sources == 0
+    assert cache.stats.file_hits == 1
+    assert _decode_url(url) == DIAGRAM_SOURCE
+
+
+def test_encoded_source_in_memory_is_not_read_in_a_thread(
+    mock_kroki_diagram_types, mocker
+) -> None:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        client = _get_client(KrokiCache(cache_dir), mock_kroki_diagram_types)
+        url = _get_url(client, {})
+        run_io_spy = mocker.spy(client, "run_io")
+
+        memory_url = _get_url(client, {})
+
+    assert memory_url == url
+    run_io_spy.assert_not_called()
+
+
+@pytest.mark.parametrize("compression_level", [0, 1, 9])
+def test_compression_level(mock_kroki_diagram_types, compression_level) -> None:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        client = _get_client(
+            KrokiCache(cache_dir), mock_kroki_diagram_types, compression_level
+        )
+        url = _get_url(client, {})
+
+    assert _decode_url(url) == DIAGRAM_SOURCE
+    expected_data = zlib.compress(DIAGRAM_SOURCE.encode(), compression_level)
+    assert urlsplit(url).path.endswith(base64.urlsafe_b64encode(expected_data).decode())
+
+
+@pytest.mark.usefixtures("kroki_dummy")
+def test_compression_level_must_be_valid() -> None:
+    # Arrange
+    with MkDocsTemplateHelper("```plantuml\nA -> B\n```") as mkdocs_helper:
+        mkdocs_helper.set_plugin_option("compression_level", 10)
+        # Act
+        result = mkdocs_helper.invoke_build()
+        # Assert
+        assert result.exit_code == 1
+        assert "Expected an integer from 0 to 9, got: 10" in result.output
@@ -5,12 +5,15 @@ import tempfile
 from contextlib import AbstractContextManager
 from pathlib import Path
 from string import Template
+from types import SimpleNamespace
 from typing import Final, Literal
 
+import bs4
 import yaml
 from click.testing import CliRunner, Result
 from mkdocs.__main__ import build_command
 
+from kroki.common import MkDocsEventContext, MkDocsFile, MkDocsFiles
 from kroki.logging import log
 from tests.compat import chdir
 
@@ -19,6 +22,23 @@ def get_expected_log_line(log_msg: str) -> str:
     return f"{log.prefix}: {log_msg}"
 
 
+def get_img_sources(html_file: Path) -> list[str]:
+    soup = bs4.BeautifulSoup(html_file.read_text(), features="html.parser")
+    return [img["src"] for img in soup.find_all("img", attrs={"alt": "Kroki"})]
+
+
+def get_page_context(site_dir: Path) -> MkDocsEventContext:
+    """Get the context of the index page of a site, without loading a config."""
+    page_file = MkDocsFile(
+        "index.md", src_dir="", dest_dir=str(site_dir), use_directory_urls=True
+    )
+    return MkDocsEventContext(
+        page=SimpleNamespace(file=page_file),
+        config=SimpleNamespace(site_dir=str(site_dir)),
+        files=MkDocsFiles([page_file]),
+    )
+
+
 class NoPluginEntryError(ValueError):
     def __init__(self) -> None:
         super().__init__("No kroki plugin entry found")
@@ -42,6 +62,9 @@ class MkDocsHelper(AbstractContextManager):
                     return plugin_entry["kroki"]
             raise NoPluginEntryError
 
+        def set_plugin_option(self, key: str, value: object) -> None:
+            self._get_plugin_config_entry()[key] = value
+
         def enable_fail_fast(self) -> None:
             self._get_plugin_config_entry()["fail_fast"] = True
 